@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import itertools as it, operator as op, functools as ft
+from time import time
+import os, sys, gc, resource, logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from graphite_metrics.collectors import CounterStore, Datapoint
+from pipeline import run_forked
+
+
+class DictStore(object):
+
+	'Old Datapoint._counter_cache implementation - dict of name: (value, ts) tuples.'
+
+	def __init__(self): self.cache = dict()
+	def __len__(self): return len(self.cache)
+	def get(self, name): return self.cache.get(name)
+	def set(self, name, value, ts): self.cache[name] = value, ts
+
+	def swap(self, name, value, ts):
+		prev = self.cache.get(name)
+		self.cache[name] = value, ts
+		return prev
+
+	def cleanup(self, ts_min):
+		cleanup_list = list( k for k,(v,ts_chk) in
+			self.cache.viewitems() if ts_min > ts_chk )
+		for k in cleanup_list: del self.cache[k]
+		return len(cleanup_list)
+
+
+def datapoint_get_dict(dp, ts=None, prefix=None, store=None):
+	'Old Datapoint.get for counters, with its dict cache (DictStore) accessed directly.'
+	ts = dp.ts or ts or time()
+	if ts > Datapoint._counter_cache_check_ts: Datapoint._counter_cache_check(ts)
+	cache = store.cache
+	if dp.name not in cache:
+		cache[dp.name] = dp.value, ts
+		return None
+	v0, ts0 = cache[dp.name]
+	if ts == ts0: return None
+	value = float(dp.value - v0) / (ts - ts0)
+	cache[dp.name] = dp.value, ts
+	if value < 0: return None
+	name = dp.name if not prefix else '{}.{}'.format(prefix, dp.name)
+	return name, value, int(ts)
+
+
+def rss_kb():
+	with open('/proc/self/statm', 'rb') as src:
+		return int(src.read().split()[1]) * resource.getpagesize() // 1024
+
+def run_store(store_type, counters, cycles):
+	names = list( 'bench.counters.group_{}.counter_{}'.format(n // 1000, n % 1000)
+		for n in xrange(counters) )
+	rss0 = rss_kb()
+	store = dict(dict=DictStore, array=CounterStore)[store_type]()
+	for n, name in enumerate(names): store.set(name, n, 1000.0 + n % 60)
+	rss = rss_kb() - rss0
+
+	ts = time()
+	for cycle in xrange(1, cycles + 1):
+		ts_cycle = 1000.0 + cycle * 60
+		for n, name in enumerate(names): store.swap(name, cycle * n, ts_cycle)
+	ts_get = (time() - ts) / (cycles * counters)
+
+	ts = time()
+	store.cleanup(1000.0 + 60) # nothing to clean up
+	ts_cleanup = time() - ts
+
+	ts = time()
+	gc.collect()
+	ts_gc = time() - ts
+
+	# Datapoint.get with the store in place of the global one, or its old dict version
+	Datapoint._counter_cache, dps = store, list(
+		Datapoint(name, 'counter', n * cycles * 2, None) for n, name in enumerate(names) )
+	dp_get = Datapoint.get if store_type != 'dict'\
+		else ft.partial(datapoint_get_dict, store=store)
+	ts_dp, ts = 1000.0 + (cycles + 1) * 60, time()
+	for dp in dps: dp_get(dp, ts_dp)
+	ts_dp_get = (time() - ts) / counters
+
+	return dict( store=store_type, counters=counters,
+		rss_mb=rss / 1024.0, bytes_per_counter=rss * 1024.0 / counters,
+		swap_per_sec=1 / ts_get, dp_get_per_sec=1 / ts_dp_get,
+		cleanup_ms=ts_cleanup * 1e3, gc_ms=ts_gc * 1e3 )
+
+
+def main(args=None):
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Benchmark memory usage and speed of counter cache implementations.')
+	parser.add_argument('-n', '--counters', default='100000,1000000',
+		help='Comma-separated list of counter numbers (default: %(default)s).')
+	parser.add_argument('-c', '--cycles', type=int, default=3, metavar='n',
+		help='Number of get/set cycles over all counters (default: %(default)s).')
+	optz = parser.parse_args(sys.argv[1:] if args is None else args)
+
+	logging.basicConfig(level=logging.ERROR)
+
+	print( '  {:<6s} {:>9s} {:>9s} {:>11s} {:>12s} {:>16s} {:>12s} {:>9s}'.format( 'store',
+		'counters', 'rss, MiB', 'bytes/cntr', 'swap/s', 'Datapoint.get/s', 'cleanup, ms', 'gc, ms' ) )
+	for counters, store_type in it.product(map(int, optz.counters.split(',')), ['dict', 'array']):
+		res = run_forked(run_store, store_type, counters, optz.cycles)
+		print( '  {store:<6s} {counters:>9d} {rss_mb:>9.1f} {bytes_per_counter:>11.1f}'
+			' {swap_per_sec:>12,.0f} {dp_get_per_sec:>16,.0f} {cleanup_ms:>12.3f} {gc_ms:>9.1f}'.format(**res) )
+		sys.stdout.flush()
+
+if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
+from contextlib import closing
+from time import time
+import os, sys, socket, json, resource, threading, timeit, logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lya import AttrDict
+
+from graphite_metrics.collectors import Collector, Datapoint, DatapointBatch
+from graphite_metrics.processors.hostname_prefix import HostnamePrefix
+from graphite_metrics.sinks import Sink
+from graphite_metrics.sinks.carbon_socket import CarbonSocket
+
+
+class SyntheticCollector(Collector):
+
+	'''Emits N series, half of them counters (growing on each read), half gauges.
+		With columnar=True, these are emitted as two DatapointBatch objects.'''
+
+	def __init__(self, conf, series, prefix='bench', columnar=False):
+		super(SyntheticCollector, self).__init__(conf)
+		self.names = list( '{}.series_{}.{}'.format(prefix, n // 100, n % 100)
+			for n in xrange(series) )
+		self.n, self.columnar = 0, columnar
+
+	def read(self):
+		self.n += 1
+		if self.columnar:
+			yield DatapointBatch(self.names[1::2], 'gauge', xrange(1, len(self.names), 2))
+			yield DatapointBatch( self.names[::2], 'counter',
+				list(self.n * n for n in xrange(0, len(self.names), 2)) )
+			return
+		for n, name in enumerate(self.names):
+			if n % 2: yield Datapoint(name, 'gauge', n, None)
+			else: yield Datapoint(name, 'counter', self.n * n, None)
+
+
+class NullSink(Sink):
+
+	def dispatch(self, *tuples): pass
+
+
+class CarbonLoopback(object):
+
+	'Local TCP server, draining everything sent to it, to use with CarbonSocket sink.'
+
+	def __init__(self):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(1)
+		self.addr = self.sock.getsockname()
+		self.received = 0
+		self.thread = threading.Thread(target=self.drain)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def drain(self):
+		conn, addr = self.sock.accept()
+		with closing(conn):
+			while True:
+				buff = conn.recv(2**20)
+				if not buff: break
+				self.received += len(buff)
+
+
+def loop_conf(**kwz):
+	conf = AttrDict(
+		interval=60, overrun_policy='skip', threads=None,
+		batch_size=None, self_stats=None, debug=AttrDict(dry_run=False) )
+	conf.update(kwz)
+	return conf
+
+def sink_conf(**kwz):
+	conf = AttrDict(
+		host=None, max_reconnects=None, reconnect_delay=1,
+		debug=AttrDict(dry_run=False) )
+	conf.update(kwz)
+	return conf
+
+
+def run_pipeline( loop_name, series, sink_type, cycles,
+		batch_size=None, columnar=False, collectors=4 ):
+	'Returns dict of results for a number of loop cycles with specified parameters.'
+	loop_cls = __import__( 'graphite_metrics.loops.{}'\
+		.format(loop_name), fromlist=['loop'] ).loop
+	loop = loop_cls(loop_conf(batch_size=batch_size))
+
+	collectors = OrderedDict(
+		('synthetic_{}'.format(n), SyntheticCollector( AttrDict(),
+			series // collectors, prefix='bench.c{}'.format(n), columnar=columnar ))
+		for n in xrange(collectors) )
+	processors = OrderedDict(hostname_prefix=HostnamePrefix(AttrDict(hostname='bench')))
+	if sink_type == 'null': sinks = dict(null=NullSink(sink_conf()))
+	elif sink_type == 'tcp':
+		server = CarbonLoopback()
+		sinks = dict(carbon_socket=CarbonSocket(sink_conf(host=server.addr)))
+	else: raise ValueError('Unknown sink type: {}'.format(sink_type))
+
+	# Polling is interleaved with other stages in streaming mode,
+	#  so its time is calculated as whatever is left of the cycle time
+	stages = dict()
+	def timed(stage, func):
+		def _timed(*argz, **kwz):
+			ts = time()
+			try: return func(*argz, **kwz)
+			finally: stages[stage] = stages.get(stage, 0) + time() - ts
+		return _timed
+	for stage in 'process', 'dispatch':
+		setattr(loop, stage, timed(stage, getattr(loop, stage)))
+
+	loop.cycle(collectors, processors, sinks) # warmup, initializes counters
+	stages.clear()
+	ts = time()
+	for n in xrange(cycles): loop.cycle(collectors, processors, sinks)
+	ts = time() - ts
+	stages['poll'] = ts - sum(stages.viewvalues())
+
+	return dict( loop=loop_name, series=series, sink=sink_type,
+		batch_size=batch_size, dps_per_sec=series * cycles / ts,
+		cycle_time=ts / cycles, maxrss_mb=resource.getrusage(
+			resource.RUSAGE_SELF ).ru_maxrss / 1024.0,
+		stages=dict((k, v / cycles) for k, v in stages.viewitems()) )
+
+def run_forked(func, *argz, **kwz):
+	'Runs func in a forked child, so that peak RSS is measured for each run separately.'
+	r, w = os.pipe()
+	pid = os.fork()
+	if not pid:
+		os.close(r)
+		try:
+			with os.fdopen(w, 'wb') as dst: json.dump(func(*argz, **kwz), dst)
+		finally: os._exit(0)
+	os.close(w)
+	with os.fdopen(r, 'rb') as src: res = src.read()
+	os.waitpid(pid, 0)
+	if not res: raise RuntimeError('Benchmark child process has failed')
+	return json.loads(res)
+
+
+def run_micro(number):
+	'Returns list of (name, seconds-per-call) for micro-benchmarks.'
+	results = list()
+	def bench(name, func):
+		results.append((name, min(timeit.repeat(func, number=number, repeat=3)) / number))
+
+	dp_gauge = Datapoint('bench.some.gauge.value', 'gauge', 123, None)
+	bench('Datapoint.get (gauge)', lambda: dp_gauge.get(ts=1000))
+	dps_counter, ts = it.cycle(Datapoint( 'bench.some.counter.{}'.format(n),
+		'counter', n, None ) for n in xrange(1000)), [1000.0]
+	def counter_get():
+		ts[0] += 1
+		next(dps_counter).get(ts=ts[0])
+	bench('Datapoint.get (counter)', counter_get)
+	dps_batch, ts_batch = DatapointBatch(list( 'bench.some.counter.{}'.format(n)
+		for n in xrange(1000) ), 'counter', range(1000)), [1000.0]
+	def counter_batch_get():
+		ts_batch[0] += 1
+		dps_batch.get(ts=ts_batch[0])
+	bench('DatapointBatch.get (counter, per datapoint)', counter_batch_get)
+	results[-1] = results[-1][0], results[-1][1] / len(dps_batch)
+
+	proc, sinks = HostnamePrefix(AttrDict(hostname='bench')), dict(null=None)
+	dp = 'bench.some.gauge.value', 123, 1000
+	bench('HostnamePrefix.process', lambda: proc.process(dp, sinks))
+	batch = [dp] * 1000
+	bench('HostnamePrefix.process_batch (per datapoint)', lambda: proc.process_batch(batch, sinks))
+	results[-1] = results[-1][0], results[-1][1] / len(batch)
+
+	class NullSocket(object):
+		def sendall(self, data): pass
+	sink = CarbonSocket(sink_conf(debug=AttrDict(dry_run=True)))
+	sink.sock = NullSocket()
+	bench('CarbonSocket.dispatch (per datapoint)', lambda: sink.dispatch(*batch))
+	results[-1] = results[-1][0], results[-1][1] / len(batch)
+	batch = DatapointBatch(list( 'bench.some.gauge.{}'.format(n)
+		for n in xrange(1000) ), 'gauge', range(1000)).get(ts=1000).with_prefix('bench.')
+	bench( 'CarbonSocket.dispatch_batches (DatapointBatch, per datapoint)',
+		lambda: sink.dispatch_batches(batch) )
+	results[-1] = results[-1][0], results[-1][1] / len(batch)
+
+	return results
+
+
+def main(args=None):
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Benchmark harvestd collect-process-dispatch pipeline.')
+	parser.add_argument('-l', '--loops', default='basic,concurrent',
+		help='Comma-separated list of loops to benchmark (default: %(default)s).')
+	parser.add_argument('-n', '--series', default='1000,10000,100000,1000000',
+		help='Comma-separated list of synthetic series counts (default: %(default)s).')
+	parser.add_argument('-s', '--sinks', default='null,tcp',
+		help='Comma-separated list of sinks to use - null and/or tcp (default: %(default)s).')
+	parser.add_argument('-b', '--batch-size', type=int, metavar='n',
+		help='Use streaming mode of the loops with specified batch size.')
+	parser.add_argument('--columnar', action='store_true',
+		help='Make synthetic collectors emit DatapointBatch objects instead of Datapoints.')
+	parser.add_argument('-c', '--cycles', type=int, default=3, metavar='n',
+		help='Number of measured loop cycles (after warmup one), default: %(default)s.')
+	parser.add_argument('-m', '--micro-number', type=int, default=100000, metavar='n',
+		help='Number of calls for micro-benchmarks, 0 to skip them (default: %(default)s).')
+	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
+	optz = parser.parse_args(sys.argv[1:] if args is None else args)
+
+	logging.basicConfig(level=logging.DEBUG if optz.debug else logging.ERROR)
+
+	if optz.micro_number:
+		print('Micro-benchmarks:')
+		for name, t in run_micro(optz.micro_number):
+			print('  {:<62s} {:8.3f} us'.format(name, t * 1e6))
+		print()
+
+	print('Pipeline:')
+	print( '  {:<12s} {:>8s} {:>5s} {:>12s} {:>9s}'
+		' {:>9s} {:>9s} {:>9s} {:>9s}'.format( 'loop', 'series', 'sink',
+			'dps/s', 'cycle, s', 'poll, s', 'proc, s', 'send, s', 'rss, MiB' ) )
+	for loop_name, series, sink_type in it.product(
+			optz.loops.split(','), map(int, optz.series.split(',')), optz.sinks.split(',') ):
+		res = run_forked( run_pipeline, loop_name, series,
+			sink_type, optz.cycles, batch_size=optz.batch_size, columnar=optz.columnar )
+		print( '  {loop:<12s} {series:>8d} {sink:>5s} {dps_per_sec:>12,.0f} {cycle_time:>9.3f}'
+			' {s[poll]:>9.3f} {s[process]:>9.3f} {s[dispatch]:>9.3f} {maxrss_mb:>9.1f}'\
+			.format(s=res['stages'], **res) )
+		sys.stdout.flush()
+
+if __name__ == '__main__': sys.exit(main())
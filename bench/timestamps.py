@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import itertools as it, operator as op, functools as ft
+from time import strptime, mktime
+from calendar import timegm
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from graphite_metrics.collectors import TimestampParser
+
+
+def sysstat_old(date, ts, utc):
+	'Old SADF.process_entry timestamp parsing.'
+	for fmt in '%Y-%m-%d %H-%M-%S', '%Y-%m-%d %H:%M:%S':
+		try: return (mktime if not utc else timegm)(strptime('{} {}'.format(date, ts), fmt))
+		except ValueError: pass
+	raise ValueError(date, ts)
+
+def cron_log_old(ts):
+	'Old CronJobs.read timestamp parsing.'
+	import iso8601
+	return timegm(iso8601.parse_date(ts).utctimetuple())
+
+
+def day_entries(interval, ts0=1792281600):
+	'Returns list of (date, time, iso8601) strings for one day of entries.'
+	from datetime import datetime
+	entries = list()
+	for ts in xrange(ts0, ts0 + 24 * 3600, interval):
+		dt = datetime.utcfromtimestamp(ts)
+		entries.append(( dt.strftime('%Y-%m-%d'),
+			dt.strftime('%H:%M:%S'), dt.strftime('%Y-%m-%dT%H:%M:%S+00:00') ))
+	return entries
+
+def run(entries, number):
+	'Returns list of (name, seconds-per-day-of-entries) results.'
+	results = list()
+	def bench(name, func):
+		results.append((name, min(timeit.repeat(func, number=number, repeat=3)) / number))
+
+	for utc in True, False:
+		parse = TimestampParser(['sysstat'])
+		label = 'utc' if utc else 'local'
+		bench( 'sysstat, strptime + {} (old)'.format('timegm' if utc else 'mktime'),
+			lambda: list(sysstat_old(date, ts, utc) for date, ts, iso in entries) )
+		bench( 'sysstat, TimestampParser ({})'.format(label),
+			lambda: list(parse('{} {}'.format(date, ts), utc=utc) for date, ts, iso in entries) )
+
+	try: import iso8601
+	except ImportError:
+		print('Skipping cron_log iso8601.parse_date benchmark - iso8601 module is not available')
+	else:
+		bench( 'cron_log, iso8601.parse_date + timegm (old)',
+			lambda: list(cron_log_old(iso) for date, ts, iso in entries) )
+	parse = TimestampParser(['iso8601'])
+	bench( 'cron_log, TimestampParser',
+		lambda: list(parse(iso) for date, ts, iso in entries) )
+
+	return results
+
+
+def main(args=None):
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Benchmark timestamp parsing in sysstat and cron_log collectors.')
+	parser.add_argument('-i', '--interval', type=int, default=10, metavar='seconds',
+		help='Interval between entries in a day of generated timestamps (default: %(default)s).')
+	parser.add_argument('-n', '--number', type=int, default=3, metavar='n',
+		help='Number of passes over all entries per measurement (default: %(default)s).')
+	optz = parser.parse_args(sys.argv[1:] if args is None else args)
+
+	entries = day_entries(optz.interval)
+	print('Parsing {} entries (one day, {}s interval):'.format(len(entries), optz.interval))
+	for name, t in run(entries, optz.number):
+		print( '  {:<48s} {:9.1f} ms {:9.2f} us/entry'\
+			.format(name, t * 1e3, t * 1e6 / len(entries)) )
+
+if __name__ == '__main__': sys.exit(main())
@@ -2,9 +2,13 @@
 
 import itertools as it, operator as op, functools as ft
 from collections import namedtuple
-from glob import iglob
-from time import time
-import os
+from threading import Lock, Event
+from time import time, mktime
+from calendar import timegm
+import os, sys, re, signal, struct
+
+try: import numpy
+except ImportError: numpy = None
 
 import logging
 log = logging.getLogger(__name__)
@@ -38,34 +42,96 @@ def rate_limit(max_interval=20, sampling=3, f=lambda x: x):
 		val += 1
 
 
-def dev_resolve( major, minor,
-		log_fails=True, _cache = dict(), _cache_time=600 ):
-	ts_now, dev_cached = time(), False
-	while True:
-		if not _cache: ts = 0
-		else:
-			dev = major, minor
-			dev_cached, ts = (None, _cache[None])\
-				if dev not in _cache else _cache[dev]
-		# Update cache, if necessary
-		if ts_now > ts + _cache_time or dev_cached is False:
-			_cache.clear()
-			for link in it.chain(iglob('/dev/mapper/*'), iglob('/dev/sd*'), iglob('/dev/xvd*')):
-				link_name = os.path.basename(link)
-				try: link_dev = os.stat(link).st_rdev
-				except OSError: continue # EPERM, EINVAL
-				_cache[(os.major(link_dev), os.minor(link_dev))] = link_name, ts_now
-			_cache[None] = ts_now
-			continue # ...and try again
-		if dev_cached: dev_cached = dev_cached.replace('.', '_')
-		elif log_fails:
+class DevResolver(object):
+
+	'''Resolves block device major/minor numbers to device names, as used in metrics.
+		Names are looked up lazily (on first use) in /sys/dev/block/<major>:<minor>
+			as kernel device name from the symlink there, or device-mapper name (same as in
+			/dev/mapper) for dm-* devices, and only names with one of "prefixes" are used.
+		Results are cached, with failed lookups expiring after neg_ttl seconds.
+		Whole cache is dropped on device node changes in /dev and /dev/mapper,
+			watched via inotify, or (if that's unavailable) after ttl seconds.'''
+
+	prefixes = 'sd', 'xvd', 'nvme', 'loop', 'md', 'rbd', 'dm-'
+	sysfs_path = '/sys/dev/block'
+	watch_paths = '/dev', '/dev/mapper'
+
+	def __init__(self, ttl=600, neg_ttl=60, check_interval=1):
+		self.ttl, self.neg_ttl, self.check_interval = ttl, neg_ttl, check_interval
+		self.cache, self.cache_ts, self.check_ts, self.inotify = dict(), time(), 0, None
+
+	def __call__(self, major, minor, log_fails=True):
+		ts_now = time()
+		if ts_now > self.check_ts: self.check(ts_now)
+		dev = major, minor
+		try:
+			name, ts_expire = self.cache[dev]
+			if ts_expire is None or ts_now < ts_expire: return name
+		except KeyError: pass
+		name = self.lookup(major, minor)
+		self.cache[dev] = name, (None if name else ts_now + self.neg_ttl)
+		if not name and log_fails:
 			log.warn( 'Unable to resolve device'
 				' from major/minor numbers: {}:{}'.format(major, minor) )
-		return dev_cached or None
+		return name
+
+	def lookup(self, major, minor):
+		path = os.path.join(self.sysfs_path, '{}:{}'.format(major, minor))
+		try: name = os.path.basename(os.readlink(path))
+		except OSError: return
+		if not name.startswith(self.prefixes): return
+		if name.startswith('dm-'):
+			try:
+				with open(os.path.join(path, 'dm', 'name'), 'rb') as src:
+					name = src.read().strip() or name
+			except (OSError, IOError): pass
+		return name.replace('.', '_')
+
+	def check(self, ts_now=None):
+		'''Drops cache if there were any device node changes (or after ttl
+			without inotify), is called from lookups at most once per check_interval.'''
+		if ts_now is None: ts_now = time()
+		if self.inotify is None: self.inotify = self._inotify_init()
+		if self.inotify:
+			changed = False
+			while True:
+				try: changed |= bool(os.read(self.inotify, 2**16))
+				except OSError: break # EAGAIN
+			if changed:
+				log.debug('Device nodes changed, dropping device name cache')
+				self.cache.clear()
+		elif ts_now > self.cache_ts + self.ttl:
+			self.cache.clear()
+			self.cache_ts = ts_now
+		self.check_ts = ts_now + self.check_interval
+
+	def _inotify_init( self,
+			_flags=0o4000 | 0o2000000, # IN_NONBLOCK | IN_CLOEXEC
+			_mask=0x40 | 0x80 | 0x100 | 0x200 ): # IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+		import ctypes, ctypes.util
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			fd = libc.inotify_init1(_flags)
+			if fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+			watches = 0
+			for path in self.watch_paths:
+				if libc.inotify_add_watch(fd, path, _mask) >= 0: watches += 1
+			if not watches:
+				os.close(fd)
+				raise OSError(ctypes.get_errno(), 'failed to add any inotify watches')
+		except (OSError, AttributeError) as err:
+			log.debug(( 'Failed to init inotify, device name cache'
+				' will be dropped every {}s instead: {}' ).format(self.ttl, err))
+			return False
+		return fd
+
+dev_resolve = DevResolver()
 
 
 class Collector(object):
 
+	_procs = None # weakset of started subprocesses
+
 	def __init__(self, conf):
 		self.conf = conf
 
@@ -74,47 +140,876 @@ class Collector(object):
 			' overidden in collector subclasses to return list of Datapoint objects.' )
 		# return [Datapoint(...), Datapoint(...), ...]
 
+	def popen(self, *argz, **kwz):
+		'''Same as subprocess.Popen, but keeps track of started
+			processes, so that these can be killed by cancel().'''
+		from subprocess import Popen
+		from weakref import WeakSet
+		proc = Popen(*argz, **kwz)
+		if self._procs is None: self._procs = WeakSet()
+		self._procs.add(proc)
+		return proc
+
+	def snapshot(self, path):
+		'''Returns Snapshot of (procfs) file contents for the current loop cycle,
+			shared with any other collectors reading the same file, see SnapshotCache.'''
+		return snapshots.get(path)
+
+	def cycle_start(self):
+		'''Called from the main loop thread at the start of each
+			cycle (before polling any collectors), does nothing by default.'''
+
+	def cancel(self):
+		'''Called (from a different thread) when read() misses its deadline,
+			to abort whatever it got stuck on, by default - kill subprocesses started via popen().'''
+		for proc in list(self._procs or list()):
+			if proc.poll() is not None: continue
+			log.debug('Killing collector subprocess (collector: {}, pid: {})'.format(self, proc.pid))
+			try: proc.kill()
+			except OSError: pass
+
+
+class ProcReader(object):
+
+	'''Keeps a (procfs) file open, to re-read it from the start on each call,
+			without open/fstat/close syscalls and file object overhead on every poll.
+		File is read into a reusable buffer (grown as necessary) with as few read()
+			syscalls as possible, and read() returns its contents as str.
+		Used by SnapshotCache, which shares these between collectors.'''
+
+	def __init__(self, path, bufsize=2**14):
+		self.path, self.buff, self.src = path, bytearray(bufsize), None
+
+	def __repr__(self): return '<ProcReader {}>'.format(self.path)
+
+	def read(self):
+		from io import FileIO
+		if not self.src: self.src = FileIO(self.path, 'rb')
+		try: size = self._read()
+		except (OSError, IOError): # retry once with a new fd, e.g. if file was replaced
+			self.close()
+			self.src = FileIO(self.path, 'rb')
+			size = self._read()
+		return memoryview(self.buff)[:size].tobytes()
+
+	def _read(self):
+		src, buff, size = self.src, self.buff, 0
+		src.seek(0)
+		while True:
+			if size == len(buff): # views of the old buffer might still be around, so no resize
+				self.buff = buff = buff + bytearray(len(buff))
+			n = src.readinto(memoryview(buff)[size:])
+			if not n: break
+			size += n
+		return size
+
+	def close(self):
+		if self.src: self.src.close()
+		self.src = None
+
+
+class Snapshot(object):
+
+	'Data from some source, captured at "ts", with lines() for file contents.'
+
+	__slots__ = 'ts', 'data', '_lines'
+
+	def __init__(self, ts, data):
+		self.ts, self.data, self._lines = ts, data, None
+
+	def __repr__(self): return '<Snapshot {:.3f} {}B>'.format(self.ts, len(self.data))
+
+	def lines(self):
+		'List of lines, shared between all users of the snapshot, so should not be modified.'
+		if self._lines is None: self._lines = self.data.splitlines()
+		return self._lines
+
+
+class SnapshotCache(object):
+
+	'''Cycle-scoped cache of data from kernel sources (e.g. procfs files),
+			shared between collectors, so that each source is read at most once per cycle,
+			and all collectors using it get the same data with the same capture timestamp.
+		Loops call invalidate() at the start of each cycle (tick boundary),
+			and in case they don't (or cache is not used from a loop),
+			snapshots are also re-read when older than max_age seconds.
+		Collectors get snapshots of files via Collector.snapshot(path), or can use
+			get(key, func) for any other data, which is then returned by func().'''
+
+	def __init__(self, max_age=60):
+		self.max_age, self.cache, self.readers = max_age, dict(), dict()
+		self.pending = dict() # key: Event, set when snapshot for key is read
+		self.lock = Lock()
+
+	def invalidate(self):
+		with self.lock:
+			self.cache.clear()
+			self.pending.clear()
+
+	def reset_after_fork(self):
+		'''Drops all state inherited by a forked child process - lock (which
+			could've been held by another thread), pending reads and parent's open files.'''
+		self.lock, self.pending = Lock(), dict()
+		self.cache.clear()
+		for reader in self.readers.viewvalues():
+			try: reader.close()
+			except (OSError, IOError): pass
+		self.readers.clear()
+
+	def get(self, key, func=None):
+		'''Returns Snapshot for key, calling func() (or reading key as
+			a file path, if func is None) to get its data, if it's not cached yet.
+			Concurrent callers for the same key wait for the first one to read it.'''
+		snap = self.cache.get(key)
+		if snap and time() - snap.ts < self.max_age: return snap
+		with self.lock:
+			snap = self.cache.get(key)
+			if snap and time() - snap.ts < self.max_age: return snap
+			event = self.pending.get(key)
+			owner = not event
+			if owner: event = self.pending[key] = Event()
+			if func is None:
+				try: func = self.readers[key].read
+				except KeyError: func = (self.readers.setdefault(key, ProcReader(key))).read
+		if not owner: # to avoid concurrent collectors reading same source twice
+			event.wait()
+			return self.get(key, func) # cached by owner, unless it failed or got invalidated
+		try:
+			ts = time()
+			snap = self.cache[key] = Snapshot(ts, func())
+		finally:
+			with self.lock:
+				if self.pending.get(key) is event: del self.pending[key]
+			event.set()
+		return snap
+
+snapshots = SnapshotCache()
+
+
+class Backpressure(object):
+
+	'''Max pressure() level of all sinks, from 0 (idle) to 1 (full), updated by loops
+		on each cycle, for collectors that can hold back non-urgent (e.g. historical) data.'''
+
+	level = 0
+
+	def update(self, sinks):
+		levels = list( sink.pressure() for sink in
+			sinks.viewvalues() if hasattr(sink, 'pressure') )
+		self.level = min(1, max(levels)) if levels else 0
+
+backpressure = Backpressure()
+
+
+class NameCache(dict):
+
+	'''Dict of metric names (or any other derived values), built by func(*key) or
+			func(key) (for non-tuple keys) on first access to cache[key], and reused
+			afterwards, so that names which are same on each cycle are only built once.
+		Hits are dict lookups, and only misses go through python code, but as these are
+			still ~2x slower than plain dict ones, it's only worth using for names that
+			need more than one str.format() or concatenation to build, e.g. sets of these.
+		Size is bounded with approximate LRU eviction - when there are "size" names,
+			all of these are moved to previous generation, from where they're moved back
+			on access, and ones that weren't accessed until the next such move are dropped.'''
+
+	def __init__(self, func, size=20000):
+		super(NameCache, self).__init__()
+		self.func, self.size, self.prev = func, size, dict()
+
+	def __missing__(self, key):
+		try: name = self.prev.pop(key)
+		except KeyError: name = self.func(*key) if isinstance(key, tuple) else self.func(key)
+		if len(self) >= self.size:
+			self.prev = dict(self)
+			self.clear()
+		self[key] = name
+		return name
+
+
+class TimestampParser(object):
+
+	'''Fast parser for fixed-format timestamps (e.g. in logs), returning unix time.
+		Formats are regexps with named groups - date, Y, m, d, H, M, S and
+			optional tz ("Z" or "[+-]HH[:]MM" offset), with first one matching locked onto,
+			and only re-detected when it stops matching, using fallback func (if any) to
+			parse timestamp when none of the formats do.
+		Date part is converted to unix time of the midnight only once per day (memoized),
+			so that only offset within the day is calculated per timestamp.
+		Timestamps without tz are parsed as UTC, or as local time, if utc=False is passed,
+			in which case memo is not used for days with DST transitions.'''
+
+	formats_builtin = dict(
+		iso8601=r'^(?P<date>(?P<Y>\d{4})-(?P<m>\d\d)-(?P<d>\d\d))'
+			r'[T ](?P<H>\d\d):(?P<M>\d\d):(?P<S>\d\d)(?:[.,]\d+)?(?P<tz>Z|[+-]\d\d:?\d\d)?$',
+		sysstat=r'^(?P<date>(?P<Y>\d{4})-(?P<m>\d\d)-(?P<d>\d\d))'
+			r' (?P<H>\d\d)[-:](?P<M>\d\d)[-:](?P<S>\d\d)$' )
+
+	def __init__(self, formats, fallback=None, memo_size=1000):
+		self.matchers = list(re.compile(self.formats_builtin.get(fmt, fmt)).match for fmt in formats)
+		self.fallback, self.memo, self.memo_size = fallback, dict(), memo_size
+		self.match = self.matchers[0]
+
+	def __call__(self, ts, utc=True):
+		match = self.match(ts)
+		if not match:
+			for fmt_match in self.matchers:
+				match = fmt_match(ts)
+				if match:
+					self.match = fmt_match
+					break
+			else:
+				if self.fallback: return self.fallback(ts)
+				raise ValueError('Unrecognized timestamp format: {!r}'.format(ts))
+		date, H, M, S = match.group('date', 'H', 'M', 'S')
+		tz = match.groupdict().get('tz')
+		offset, utc = int(H) * 3600 + int(M) * 60 + int(S), utc or bool(tz)
+		try: ts_day = self.memo[date, utc]
+		except KeyError: ts_day = self._day(match, utc)
+		if ts_day is None: # local time on DST transition day
+			return int(mktime(tuple(map(int, match.group('Y', 'm', 'd', 'H', 'M', 'S'))) + (0, 0, -1)))
+		if tz and tz != 'Z':
+			tz = tz.replace(':', '')
+			offset -= (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60) * (1 if tz[0] == '+' else -1)
+		return ts_day + offset
+
+	def _day(self, match, utc):
+		day = tuple(map(int, match.group('Y', 'm', 'd')))
+		if utc: ts_day = timegm(day + (0, 0, 0))
+		else:
+			ts_day = int(mktime(day + (0, 0, 0, 0, 0, -1)))
+			ts_next = int(mktime(day[:2] + (day[2] + 1, 0, 0, 0, 0, 0, -1)))
+			if ts_next - ts_day != 24 * 3600: ts_day = None
+		if len(self.memo) >= self.memo_size: self.memo.clear()
+		self.memo[match.group('date'), utc] = ts_day
+		return ts_day
+
+
+class CounterStore(object):
+
+	'''Compact storage for last (value, timestamp) of each counter, to calculate rates.
+		Names are mapped to slot indexes in parallel typed arrays of values
+			and timestamps (doubles), with freed slots being reused, so that there are
+			no per-counter tuples/floats for gc to track and allocator to fragment.
+		Slots are counted in generations by their last update time (gen_period seconds
+				each), so cleanup only does anything when there are whole generations older
+				than the cutoff, and then only scans up to cleanup_step slots per call,
+				resuming from the same position on the next one.'''
+
+	def __init__(self, gen_period=3600, cleanup_step=20000):
+		from array import array
+		self.gen_period, self.cleanup_step = gen_period, cleanup_step
+		self.slots, self.names, self.free = dict(), list(), list()
+		self.values, self.ts = array('d'), array('d')
+		self.gens, self.cleanup_pos = dict(), 0
+		self.journal = None # list of changed slots, if set, see CounterSnapshot
+
+	def __len__(self): return len(self.slots)
+	def __contains__(self, name): return name in self.slots
+
+	def get(self, name):
+		'Returns (value, ts) tuple for a counter name or None.'
+		slot = self.slots.get(name)
+		if slot is None: return None
+		return self.values[slot], self.ts[slot]
+
+	def set(self, name, value, ts):
+		self.swap(name, value, ts)
+
+	def swap(self, name, value, ts):
+		'''Stores new (value, ts) for a counter,
+			returning previous (value, ts) tuple for it or None, if it's a new one.'''
+		slot, gen = self.slots.get(name), int(ts // self.gen_period)
+		if slot is None:
+			if self.free:
+				slot = self.free.pop()
+				self.names[slot], self.values[slot], self.ts[slot] = name, value, ts
+			else:
+				slot = len(self.names)
+				self.names.append(name), self.values.append(value), self.ts.append(ts)
+			self.slots[name] = slot
+			if self.journal is not None: self.journal.append(slot)
+			prev = None
+		else:
+			prev = self.values[slot], self.ts[slot]
+			self.values[slot], self.ts[slot] = value, ts
+			gen_old = int(prev[1] // self.gen_period)
+			if gen_old == gen: return prev
+			self._gen_discard(gen_old)
+		self.gens[gen] = self.gens.get(gen, 0) + 1
+		return prev
+
+	def gen_update(self, ts_old, ts):
+		'Moves slot from generation of ts_old to the one of ts, for updates done in-place.'
+		self._gen_discard(int(ts_old // self.gen_period))
+		gen = int(ts // self.gen_period)
+		self.gens[gen] = self.gens.get(gen, 0) + 1
+
+	def swap_batch(self, names, values, ts):
+		'''Same as swap() for a sequence of counters, with ts being either a single
+				timestamp or a sequence of these, returning (values, ts) columns of
+				previous values, with ts=-inf for new counters.
+			Updates of existing counters are vectorized, if numpy is available.'''
+		count, ts_seq = len(names), not isinstance(ts, (int, long, float))
+		if numpy is None:
+			from array import array
+			prev_values, prev_ts = array('d', [0]) * count, array('d', [float('-inf')]) * count
+			for n, name, value, ts_dp in it.izip( it.count(),
+					names, values, ts if ts_seq else it.repeat(ts) ):
+				prev = self.swap(name, value, ts_dp)
+				if prev: prev_values[n], prev_ts[n] = prev
+			return prev_values, prev_ts
+
+		slots_get, prev_values = self.slots.get, numpy.zeros(count)
+		prev_ts = numpy.full(count, -numpy.inf)
+		slots = numpy.fromiter((slots_get(name, -1) for name in names), numpy.intp, count)
+		values = numpy.asarray(values, dtype=numpy.float64)
+		ts = numpy.broadcast_to(numpy.asarray(ts, dtype=numpy.float64), (count,))
+		mask = slots >= 0
+		for n in numpy.flatnonzero(~mask): self.swap(names[n], values[n], ts[n])
+		if not mask.any(): return prev_values, prev_ts
+		slots = slots[mask]
+		# Views of arrays have to be dropped before these can be resized again
+		col_values, col_ts = (numpy.frombuffer(col, dtype=numpy.float64) for col in [self.values, self.ts])
+		prev_values[mask], prev_ts[mask] = col_values[slots], col_ts[slots]
+		col_values[slots], col_ts[slots] = values[mask], ts[mask]
+		del col_values, col_ts
+		gen_period = float(self.gen_period)
+		gens_old, gens = ( (col[mask] // gen_period).astype(numpy.int64)
+			for col in [prev_ts, ts] )
+		changed = gens_old != gens
+		if changed.any():
+			for gen, n in it.izip(*numpy.unique(gens_old[changed], return_counts=True)):
+				self._gen_discard(int(gen), int(n))
+			for gen, n in it.izip(*numpy.unique(gens[changed], return_counts=True)):
+				self.gens[int(gen)] = self.gens.get(int(gen), 0) + int(n)
+		return prev_values, prev_ts
+
+	def _gen_discard(self, gen, count=1):
+		n = self.gens[gen] - count
+		if n > 0: self.gens[gen] = n
+		else: del self.gens[gen]
+
+	def cleanup(self, ts_min):
+		'''Drops (some of) the counters last updated before ts_min,
+			returns number of these or None if there are none left to drop.'''
+		gen_min = int(ts_min // self.gen_period)
+		if not any(gen < gen_min for gen in self.gens): return None
+		names, ts, count, dropped = self.names, self.ts, len(self.names), 0
+		pos = self.cleanup_pos
+		for n in xrange(min(self.cleanup_step, count)):
+			pos = (pos + 1) % count
+			if names[pos] is None or ts[pos] >= ts_min: continue
+			del self.slots[names[pos]]
+			self._gen_discard(int(ts[pos] // self.gen_period))
+			names[pos] = None
+			self.free.append(pos)
+			if self.journal is not None: self.journal.append(pos)
+			dropped += 1
+		self.cleanup_pos = pos
+		return dropped
+
+
+class CounterSnapshot(object):
+
+	'''On-disk copy of CounterStore state, to keep calculating rates across restarts.
+		Values and timestamps are stored in a memory-mapped file as two columns
+			of native doubles, same as in store arrays, and are overwritten in-place
+			on each sync(), so that only changed pages are written-out by the kernel.
+		Slot names are stored one per line (empty for free slots) in "<path>.names",
+			with changes to these appended as "slot<tab>name" lines to "<path>.names.log",
+			which gets merged into the former on load() or when it grows too large.
+		On load(), names are read as a list and the columns are copied into
+			store arrays as-is, so no per-counter objects are (un)pickled,
+			and stale entries are left for the usual incremental store cleanup.'''
+
+	magic = 'harvestd-counters:1:{}\n'.format(sys.byteorder[0])
+	header = struct.Struct('={}sQ'.format(len(magic))) # magic, capacity
+	header_size = 64
+
+	def __init__(self, path, store):
+		self.path, self.store = path, store
+		self.path_names = '{}.names'.format(path)
+		self.path_log = '{}.log'.format(self.path_names)
+		self.mm = self.log = None
+		self.capacity = 0
+
+	def load(self):
+		'''Loads snapshot into the store (which should be empty), if it exists,
+			and starts tracking changes to it. Returns number of loaded counters.'''
+		from array import array
+		store = self.store
+		try:
+			with open(self.path, 'rb') as src: header = src.read(self.header.size)
+			magic, capacity = self.header.unpack(header)
+			if magic != self.magic: raise ValueError('magic mismatch')
+			with open(self.path_names, 'rb') as src: names = src.read().splitlines()
+			try:
+				with open(self.path_log, 'rb') as src: changes = src.read().splitlines()
+			except (OSError, IOError): changes = None
+			if changes:
+				for line in changes:
+					slot, name = line.split('\t', 1)
+					slot = int(slot)
+					if slot >= len(names): names.extend([''] * (slot + 1 - len(names)))
+					names[slot] = name
+			if len(names) > capacity: raise ValueError('names/values mismatch')
+			self._open(capacity)
+		except (OSError, IOError, ValueError, struct.error) as err:
+			if os.path.exists(self.path) or os.path.exists(self.path_names):
+				log.warn(( 'Failed to load counter state'
+					' from {}, discarding it: {}' ).format(self.path, err))
+			names = changes = None
+			self._open(0, clear=True)
+		else:
+			count, offset = len(names), self.header_size
+			store.values, store.ts = array('d'), array('d')
+			store.values.fromstring(self.mm[offset:offset + 8*count])
+			offset += 8*self.capacity
+			store.ts.fromstring(self.mm[offset:offset + 8*count])
+			store.names = list(name or None for name in names)
+			store.slots = dict(it.izip(store.names, it.count()))
+			store.slots.pop(None, None)
+			store.free = list(it.compress(xrange(count), it.imap(op.not_, names)))
+			store.gens = dict( (int(gen), len(list(slots))) for gen, slots in it.groupby(sorted(it.imap(
+				float(store.gen_period).__rfloordiv__, it.imap(store.ts.__getitem__, store.slots.viewvalues()) ))) )
+		if changes: self._write_names()
+		self.log = open(self.path_log, 'ab')
+		store.journal = list()
+		return len(store.slots)
+
+	def _open(self, capacity, clear=False):
+		import mmap
+		if self.mm: self.mm.close()
+		with open(self.path, 'r+b' if not clear else 'w+b') as dst:
+			if clear:
+				for path in self.path_names, self.path_log: open(path, 'wb').close()
+			dst.truncate(self.header_size + 16*capacity)
+			self.mm = mmap.mmap(dst.fileno(), 0)
+		self.mm[:self.header.size] = self.header.pack(self.magic, capacity)
+		self.capacity = capacity
+
+	def _write_names(self):
+		path_tmp = '{}.new'.format(self.path_names)
+		with open(path_tmp, 'wb') as dst:
+			dst.write('\n'.join(it.imap(self._name, self.store.names)))
+			dst.write('\n')
+		os.rename(path_tmp, self.path_names)
+		if self.log: self.log.close()
+		self.log = open(self.path_log, 'wb')
+
+	def _name(self, name):
+		if not name: return ''
+		if isinstance(name, unicode): name = name.encode('utf-8')
+		if '\n' in name: return '' # can't be stored, won't be loaded
+		return name
+
+	def sync(self):
+		'''Writes slot name changes and all store values/timestamps to the snapshot.
+			Snapshot is grown (and rewritten) as necessary.'''
+		store = self.store
+		if store.journal:
+			if len(store.journal) > len(store.names) // 4: self._write_names()
+			else:
+				for slot in sorted(set(store.journal)):
+					self.log.write('{}\t{}\n'.format(slot, self._name(store.names[slot])))
+				self.log.flush()
+			del store.journal[:]
+		count = len(store.names)
+		if count > self.capacity: self._open(max(count * 2, 1024))
+		offset = self.header_size
+		self.mm[offset:offset + 8*count] = store.values.tostring()
+		offset += 8*self.capacity
+		self.mm[offset:offset + 8*count] = store.ts.tostring()
+
+	def close(self):
+		if self.mm: self.mm.close()
+		if self.log: self.log.close()
+		self.mm = self.log = None
+
 
 class Datapoint(namedtuple('Value', 'name type value ts')):
 
 	# These are globals
-	_counter_cache = dict()
+	_counter_cache = CounterStore()
 	_counter_cache_check_ts = 0
 	_counter_cache_check_timeout = 12 * 3600 # 12h
-	_counter_cache_check_count = 4 # cleanup will trigger every timeout/count period
+	_counter_cache_check_interval = 60 # incremental cleanup steps, see CounterStore
 
 	@classmethod
 	def _counter_cache_cleanup(cls, ts_min):
-		cleanup_list = list( k for k,(v,ts_chk) in
-			cls._counter_cache.viewitems() if ts_min > ts_chk )
-		log.debug('Counter cache cleanup: {} buckets'.format(len(cleanup_list)))
-		for k in cleanup_list: del cls._counter_cache[k]
+		dropped = cls._counter_cache.cleanup(ts_min)
+		if dropped is not None:
+			log.debug('Counter cache cleanup: {} buckets'.format(dropped))
 
-	def get(self, ts=None, prefix=None):
-		ts = self.ts or ts or time()
+	@staticmethod
+	def _counter_cache_check(ts):
 		if ts > Datapoint._counter_cache_check_ts:
 			Datapoint._counter_cache_cleanup(
 				ts - Datapoint._counter_cache_check_timeout )
 			Datapoint._counter_cache_check_ts = ts\
-				+ Datapoint._counter_cache_check_timeout\
-				/ Datapoint._counter_cache_check_count
-		if self.type == 'counter':
-			if self.name not in Datapoint._counter_cache:
-				log.debug('Initializing bucket for new counter: {}'.format(self.name))
-				Datapoint._counter_cache[self.name] = self.value, ts
+				+ Datapoint._counter_cache_check_interval
+
+	def get(self, ts=None, prefix=None):
+		name, dp_type, dp_value, dp_ts = self # faster than namedtuple properties
+		ts = dp_ts or ts or time()
+		if ts > Datapoint._counter_cache_check_ts: Datapoint._counter_cache_check(ts)
+		if dp_type == 'counter':
+			# Same as _counter_cache.swap(), inlined for existing counters, as it's the hot path
+			store = Datapoint._counter_cache
+			slot = store.slots.get(name)
+			if slot is None:
+				store.swap(name, dp_value, ts)
+				log.debug('Initializing bucket for new counter: {}'.format(name))
+				return None
+			values, ts_col = store.values, store.ts
+			v0, ts0 = values[slot], ts_col[slot]
+			values[slot], ts_col[slot] = dp_value, ts
+			if ts0 // store.gen_period != ts // store.gen_period: store.gen_update(ts0, ts)
+			if ts - ts0 > Datapoint._counter_cache_check_timeout:
+				log.debug('Re-initializing bucket for stale counter: {}'.format(name))
 				return None
-			v0, ts0 = Datapoint._counter_cache[self.name]
 			if ts == ts0:
-				log.warn('Double-poll of a counter for {!r}'.format(self.name))
+				log.warn('Double-poll of a counter for {!r}'.format(name))
 				return None
-			value = float(self.value - v0) / (ts - ts0)
-			Datapoint._counter_cache[self.name] = self.value, ts
+			value = float(dp_value - v0) / (ts - ts0)
 			if value < 0:
 				# TODO: handle overflows properly, w/ limits
 				log.debug( 'Detected counter overflow'
-					' (negative delta): {}, {} -> {}'.format(self.name, v0, self.value) )
+					' (negative delta): {}, {} -> {}'.format(name, v0, dp_value) )
 				return None
-		elif self.type == 'gauge': value = self.value
-		else: raise TypeError('Unknown type: {}'.format(self.type))
-		name = self.name if not prefix else '{}.{}'.format(prefix, self.name)
+		elif dp_type == 'gauge': value = dp_value
+		else: raise TypeError('Unknown type: {}'.format(dp_type))
+		if prefix: name = '{}.{}'.format(prefix, name)
 		return name, value, int(ts)
+
+
+class DatapointBatch(object):
+
+	'''Columnar batch of same-type datapoints, which collectors can yield instead
+			of many separate Datapoint objects, e.g. for table-like /proc files.
+		Names are stored as a list, with optional prefix to prepend to each one as-is
+			(e.g. "irq."), values as any sequence and timestamp can be either a single
+			value for the whole batch (or None, same as for Datapoint) or a sequence.
+		get() returns new batch with final values, same as Datapoint.get() would for each
+			datapoint, with counter rates calculated for the whole batch at once (vectorized,
+			if numpy is available) and datapoints that would be None (e.g. new counters) dropped.
+		Iterating over such batch yields (name, value, ts) tuples, same as returned by
+			Datapoint.get(), so it can be passed to any processors and sinks that expect these.'''
+
+	__slots__ = 'names', 'type', 'values', 'ts', 'prefix'
+
+	def __init__(self, names, type, values, ts=None, prefix=None):
+		self.names, self.type, self.values, self.ts, self.prefix = names, type, values, ts, prefix
+
+	def __repr__(self):
+		return '<DatapointBatch {} {}*{}>'.format(self.type, self.prefix or '', len(self.names))
+
+	def __len__(self): return len(self.names)
+
+	def __iter__(self):
+		names = self.names if not self.prefix else it.imap(self.prefix.__add__, self.names)
+		ts = self.ts if not isinstance(self.ts, (int, long, float)) else it.repeat(self.ts)
+		return it.izip(names, self.values, ts)
+
+	def with_prefix(self, prefix):
+		'Returns same batch with specified prefix prepended to names.'
+		return DatapointBatch( self.names, self.type,
+			self.values, self.ts, prefix + (self.prefix or '') )
+
+	def datapoints(self):
+		'Returns iterable of Datapoint objects, equivalent to this batch.'
+		names = self.names if not self.prefix else it.imap(self.prefix.__add__, self.names)
+		ts = self.ts if self.ts is not None\
+			and not isinstance(self.ts, (int, long, float)) else it.repeat(self.ts)
+		return it.starmap(Datapoint, it.izip(names, it.repeat(self.type), self.values, ts))
+
+	def get(self, ts=None, prefix=None):
+		ts = self.ts if self.ts is not None else (ts or time())
+		ts_seq = not isinstance(ts, (int, long, float))
+		Datapoint._counter_cache_check(ts if not ts_seq else max(ts))
+		prefix = '{}.'.format(prefix) if prefix else ''
+		if self.type == 'counter':
+			names = self.names if not self.prefix else map(self.prefix.__add__, self.names)
+			names, values, ts = self._rates(names, ts, ts_seq)
+		elif self.type == 'gauge':
+			names, values, prefix = self.names, self.values, prefix + (self.prefix or '')
+			ts = int(ts) if not ts_seq else map(int, ts)
+		else: raise TypeError('Unknown type: {}'.format(self.type))
+		if not names: return None
+		return DatapointBatch(names, 'gauge', values, ts, prefix or None)
+
+	def _rates(self, names, ts, ts_seq):
+		prev_values, prev_ts = Datapoint._counter_cache.swap_batch(names, self.values, ts)
+		timeout, polls_double = Datapoint._counter_cache_check_timeout, 0
+		if numpy is not None:
+			values, ts = (numpy.asarray(col, dtype=numpy.float64) for col in [self.values, ts])
+			with numpy.errstate(divide='ignore', invalid='ignore'):
+				ts_delta = ts - prev_ts
+				rates = (values - prev_values) / ts_delta
+				idx = numpy.flatnonzero((ts_delta > 0) & (ts_delta <= timeout) & (rates >= 0))
+			polls_double = numpy.count_nonzero(ts_delta == 0)
+			names, values = list(names[n] for n in idx), rates[idx].tolist()
+			ts = int(ts) if not ts_seq else ts[idx].astype(numpy.int64).tolist()
+		else:
+			data = list()
+			for name, value, ts_dp, v0, ts0 in it.izip( names,
+					self.values, ts if ts_seq else it.repeat(ts), prev_values, prev_ts ):
+				ts_delta = ts_dp - ts0
+				if ts_delta == 0: polls_double += 1
+				if not 0 < ts_delta <= timeout: continue
+				value = (value - v0) / ts_delta
+				if value >= 0: data.append((name, value, int(ts_dp)))
+			names, values, ts = map(list, it.izip(*data)) if data else (list(), list(), list())
+			if not ts_seq and ts: ts = ts[0]
+		if polls_double:
+			log.warn('Double-poll of {} counter(s) in a batch: {!r}'.format(polls_double, self))
+		return names, values, ts
+
+
+class DatapointStream(object):
+
+	'''Compact binary framing for streams of datapoints and markers between these,
+			used to pass data between processes and in record/replay files.
+		Frame: header (flags byte, name length), name,
+			value (int64 or double, if flag_value is set), ts (double, if flag_ts is set).'''
+
+	frame_head = struct.Struct('!BH')
+	frame_value = {False: struct.Struct('!d'), True: struct.Struct('!q')}
+	frame_ts = struct.Struct('!d')
+	flag_counter, flag_int, flag_ts, flag_value = 1, 2, 4, 8
+	flag_poll, flag_cycle, flag_error, flag_end = 16, 32, 64, 128
+
+	def __init__(self, stream):
+		self.stream = stream
+
+	def write(self, dp):
+		if isinstance(dp, DatapointBatch):
+			for dp in dp.datapoints(): self.write(dp)
+			return
+		name = dp.name if not isinstance(dp.name, unicode) else dp.name.encode('utf-8')
+		flags, value = self.flag_value, dp.value
+		if dp.type == 'counter': flags |= self.flag_counter
+		if isinstance(value, (int, long)) and -2**63 <= value < 2**63: flags |= self.flag_int
+		if dp.ts is not None: flags |= self.flag_ts
+		self.stream.write( self.frame_head.pack(flags, len(name)) + name
+			+ self.frame_value[bool(flags & self.flag_int)].pack(value)
+			+ (self.frame_ts.pack(dp.ts) if dp.ts is not None else '') )
+
+	def write_marker(self, flags, name='', ts=None):
+		if isinstance(name, unicode): name = name.encode('utf-8')
+		name = name[:2**16-1]
+		if ts is not None: flags |= self.flag_ts
+		self.stream.write( self.frame_head.pack(flags, len(name))
+			+ name + (self.frame_ts.pack(ts) if ts is not None else '') )
+
+	def read(self):
+		'''Returns next (flags, name, value, ts) frame,
+			None on EOF at the frame boundary, raising EOFError on truncated frames.'''
+		buff = self.stream.read(self.frame_head.size)
+		if not buff: return
+		try:
+			flags, name_len = self.frame_head.unpack(buff)
+			name, value, ts = self.stream.read(name_len), None, None
+			if flags & self.flag_value:
+				val_fmt = self.frame_value[bool(flags & self.flag_int)]
+				value, = val_fmt.unpack(self.stream.read(val_fmt.size))
+			if flags & self.flag_ts: ts, = self.frame_ts.unpack(self.stream.read(self.frame_ts.size))
+		except struct.error: raise EOFError('Truncated datapoint frame')
+		if len(name) != name_len: raise EOFError('Truncated datapoint frame')
+		return flags, name, value, ts
+
+	def datapoint(self, frame, ts_default=None):
+		flags, name, value, ts = frame
+		return Datapoint( name, 'counter' if flags & self.flag_counter else 'gauge',
+			value, ts if ts is not None else ts_default )
+
+
+class IsolatedCollector(Collector):
+
+	'''Wrapper to run collector in a long-lived child process, forked with
+			already-initialized collector object and restarted if it fails or hangs.
+		Child runs collector.read() on each request from the pipe, and streams
+			resulting datapoints back over another one, using DatapointStream framing.
+		Counter values are passed as-is, rates are calculated in the main process.'''
+
+	_fds_parent = set() # to close these in all forked children
+
+	def __init__(self, collector):
+		super(IsolatedCollector, self).__init__(collector.conf)
+		self.collector, self.pid = collector, None
+		self.fds_init = self._fds() # to close any sockets opened after that in children
+		self.spawn()
+
+	def __repr__(self): return '<IsolatedCollector {!r}>'.format(self.collector)
+
+	@staticmethod
+	def _fds():
+		fds = set()
+		for fd in map(int, os.listdir('/proc/self/fd')):
+			try: os.fstat(fd) # skip fd of the listed dir itself
+			except OSError: continue
+			fds.add(fd)
+		return fds
+
+	def spawn(self):
+		'''Starts child process, which should only be done from
+			the main loop thread, either on init or via cycle_start().'''
+		(req_r, req_w), (res_r, res_w) = os.pipe(), os.pipe()
+		pid = os.fork()
+		if not pid:
+			try:
+				self._child_init([req_w, res_r] + list(self._fds_parent), [req_r, res_w])
+				self._child(req_r, DatapointStream(os.fdopen(res_w, 'wb')))
+			finally: os._exit(0)
+		os.close(req_r), os.close(res_w)
+		self.pid, self.req, self.res = pid, req_w, DatapointStream(os.fdopen(res_r, 'rb'))
+		self._fds_parent.update([req_w, res_r])
+		log.debug('Started child process for collector {} (pid: {})'.format(self.collector, pid))
+
+	def kill(self):
+		'Stops child process, new one will be started on the next read().'
+		if not self.pid: return
+		log.debug('Stopping child process for collector {} (pid: {})'.format(self.collector, self.pid))
+		self._fds_parent.difference_update([self.req, self.res.stream.fileno()])
+		try: os.kill(self.pid, signal.SIGKILL)
+		except OSError: pass
+		os.waitpid(self.pid, 0)
+		os.close(self.req)
+		self.res.stream.close()
+		self.pid = None
+
+	def cancel(self):
+		# Child will be reaped and restarted in read(), after it gets EOF
+		if not self.pid: return
+		try: os.kill(self.pid, signal.SIGKILL)
+		except OSError: pass
+
+	def _child_init(self, fds_close, fds_keep):
+		'''Resets state that forked child has inherited from parent threads: re-creates logging
+				locks (used by collector) and SnapshotCache lock, which could've been held at the time
+				of fork, and closes pipes to other children and parent's files/sockets (e.g. sinks').
+			Only sockets are closed from fds opened in parent after collector init,
+				as other files might be used by objects shared with collector (e.g. dev_resolve).'''
+		import logging, threading
+		logging._lock = threading.RLock()
+		for handler in logging._handlerList:
+			handler = handler()
+			if handler: handler.createLock()
+		snapshots.reset_after_fork()
+		import stat
+		for fd in self._fds().difference(self.fds_init, fds_keep):
+			if stat.S_ISSOCK(os.fstat(fd).st_mode): fds_close.append(fd)
+		for fd in fds_close:
+			try: os.close(fd)
+			except OSError: pass
+
+	def _child(self, req, res):
+		while os.read(req, 1): # EOF - parent is gone
+			snapshots.invalidate() # new cycle in the parent
+			try:
+				for dp in self.collector.read(): res.write(dp)
+			except Exception as err:
+				res.write_marker(res.flag_error, '{}: {}'.format(err.__class__.__name__, err))
+			res.write_marker(res.flag_end)
+			res.stream.flush()
+
+	def _read(self):
+		os.write(self.req, '\n')
+		error = None
+		while True:
+			frame = self.res.read()
+			if not frame: raise EOFError('Unexpected EOF from child process')
+			flags, name = frame[:2]
+			if flags & self.res.flag_end: break
+			if flags & self.res.flag_error: error = name
+			else: yield self.res.datapoint(frame)
+		if error: raise RuntimeError('Collector child process error: {}'.format(error))
+
+	def cycle_start(self):
+		# Child is only (re-)started from the main thread, as forking from others
+		#  can leave it with copies of locks that were held there at the time
+		if not self.pid: self.spawn()
+
+	def read(self):
+		if not self.pid:
+			log.warn(( 'Child process for collector {} is not running,'
+				' will be restarted on the next cycle' ).format(self.collector))
+			return
+		done = False
+		try:
+			for dp in self._read(): yield dp
+			done = True
+		except (OSError, IOError, EOFError) as err:
+			log.warn('Collector child process failure ({}), restarting it: {}'.format(self.collector, err))
+			raise
+		except RuntimeError: # error in collector itself, child is fine
+			done = True
+			raise
+		finally:
+			# Child can be in any state if read was interrupted, so it's easier to restart it
+			if not done: self.kill()
+
+
+class Recorder(object):
+
+	'''Records datapoints from each collector poll to a file,
+			with per-cycle and per-poll markers and timestamps, using DatapointStream framing.
+		Such file can be replayed through processors and sinks with ReplayCollector.'''
+
+	magic = 'harvestd-record:1\n'
+
+	def __init__(self, path):
+		from threading import Lock
+		self.stream, self.lock = DatapointStream(open(path, 'wb')), Lock()
+		self.stream.stream.write(self.magic)
+
+	def cycle(self, ts):
+		with self.lock:
+			self.stream.write_marker(self.stream.flag_cycle, ts=ts)
+
+	def poll(self, name, ts, datapoints):
+		with self.lock:
+			self.stream.write_marker(self.stream.flag_poll, name, ts=ts)
+			for dp in datapoints: self.stream.write(dp)
+			self.stream.stream.flush()
+
+
+class ReplayCollector(Collector):
+
+	'''Pseudo-collector to replay data, recorded by Recorder, one cycle per read().
+		Datapoints without timestamps get these from the poll markers,
+			so that counter rates are calculated same as they were on recording.
+		If speed is set, read() will sleep until recorded cycle time (relative to the
+			first one, divided by speed), otherwise cycles are replayed as fast as possible.
+		"done" attribute gets set after the last cycle was returned.'''
+
+	def __init__(self, path, speed=1.0):
+		super(ReplayCollector, self).__init__(dict())
+		src = open(path, 'rb')
+		if src.read(len(Recorder.magic)) != Recorder.magic:
+			raise ValueError('Not a harvestd record file: {}'.format(path))
+		self.stream, self.speed, self.done = DatapointStream(src), speed, False
+		self.ts_offset, self.frame = None, self.stream.read()
+
+	def read(self):
+		from time import sleep
+		if self.frame is None: self.done = True
+		if self.done: return list()
+		stream, data = self.stream, list()
+		flags, name, value, ts_cycle = self.frame
+		if self.speed:
+			if self.ts_offset is None: self.ts_offset = time() - ts_cycle / self.speed
+			ts_sleep = self.ts_offset + ts_cycle / self.speed - time()
+			if ts_sleep > 0: sleep(ts_sleep)
+		ts_poll = ts_cycle
+		while True:
+			if flags & stream.flag_poll: ts_poll = self.frame[3]
+			elif flags & stream.flag_value: data.append(stream.datapoint(self.frame, ts_poll))
+			self.frame = stream.read()
+			if self.frame is None:
+				self.done = True
+				break
+			flags = self.frame[0]
+			if flags & stream.flag_cycle: break
+		return data
@@ -7,7 +7,7 @@ from io import open
 from os.path import join, ismount
 import os, re, dbus, fcntl, stat
 
-from . import Collector, Datapoint, user_hz, dev_resolve
+from . import Collector, Datapoint, NameCache, user_hz, dev_resolve
 
 import logging
 log = logging.getLogger(__name__)
@@ -132,8 +132,14 @@ class CGAcct(Collector):
 			key=lambda k: (k.rsplit('@', 1)[0]+'@' if '@' in k else k) ) )
 
 
+	@staticmethod
+	def _svc_names(template):
+		'''Returns cache of per-service caches of metric names,
+			built from specified template with service name and key(s).'''
+		return NameCache(lambda svc: NameCache(ft.partial(template.format, svc), 1000), 5000)
+
 	def cpuacct( self, services,
-			_name = 'processes.services.{}.cpu.{}'.format,
+			_names = _svc_names.__func__('processes.services.{}.cpu.{}'),
 			_stats=('user', 'system') ):
 		## "stats" counters (user/system) are reported in USER_HZ - 1/Xth of second
 		##  yielded values are in seconds, so counter should have 0-1 range,
@@ -144,7 +150,7 @@ class CGAcct(Collector):
 				log.warn('Detected service name conflict with "total" aggregation')
 				continue
 			# user/system jiffies
-			stat = dict()
+			names, stat = _names[svc], dict()
 			for path in self._cg_svc_metrics('cpuacct', 'stat', svc_instances):
 				try:
 					with self._cg_metric(path) as src:
@@ -155,7 +161,7 @@ class CGAcct(Collector):
 				except (OSError, IOError): pass
 			for name in _stats:
 				if name not in stat: continue
-				yield Datapoint( _name(svc, name),
+				yield Datapoint( names[name],
 					'counter', float(stat[name]) / user_hz, None )
 			# usage clicks
 			usage = None
@@ -165,7 +171,7 @@ class CGAcct(Collector):
 						usage = (0 if usage is None else usage) + int(src.read().strip())
 				except (OSError, IOError): pass
 			if usage is not None:
-				yield Datapoint(_name(svc, 'usage'), 'counter', usage, None)
+				yield Datapoint(names['usage'], 'counter', usage, None)
 
 
 	@staticmethod
@@ -199,7 +205,8 @@ class CGAcct(Collector):
 			_caches=deque([dict()], maxlen=2),
 			_re_line = re.compile( r'^(?P<dev>\d+:\d+)\s+'
 				r'(?P<iotype>Read|Write)\s+(?P<count>\d+)$' ),
-			_name = 'processes.services.{}.io.{}'.format ):
+			_names = _svc_names.__func__('processes.services.{}.{}'),
+			_names_blkio = _svc_names.__func__('processes.services.{}.io.blkio.{}.{}_{}') ):
 		# Caches are for syscall io
 		cache_prev = _caches[-1]
 		cache_update = dict()
@@ -209,7 +216,7 @@ class CGAcct(Collector):
 			## Block IO
 			## Only reads/writes are accounted, sync/async is meaningless now,
 			##  because only sync ops are counted anyway
-			svc_io = dict()
+			names, names_blkio, svc_io = _names[svc], _names_blkio[svc], dict()
 			for metric, src in [ ('bytes', 'io_service_bytes'),
 					('time', 'io_service_time'), ('ops', 'io_serviced') ]:
 				dst = svc_io.setdefault(metric, dict())
@@ -233,8 +240,7 @@ class CGAcct(Collector):
 						continue
 					for k,v in vals.viewitems():
 						if not v: continue # no point writing always-zeroes for most devices
-						yield Datapoint(_name( svc,
-							'blkio.{}.{}_{}'.format(dev, metric, k) ), 'counter', v, None)
+						yield Datapoint(names_blkio[dev, metric, k], 'counter', v, None)
 
 			## Syscall IO
 			## Counters from blkio seem to be less useful in general,
@@ -250,10 +256,8 @@ class CGAcct(Collector):
 						pids.update(self._read_ids(src))
 				except (OSError, IOError): continue
 			# Process/thread count - only collected here
-			yield Datapoint( 'processes.services.'
-				'{}.threads'.format(svc), 'gauge', len(tids), None)
-			yield Datapoint( 'processes.services.'
-				'{}.processes'.format(svc), 'gauge', len(pids), None )
+			yield Datapoint(names['threads'], 'gauge', len(tids), None)
+			yield Datapoint(names['processes'], 'gauge', len(pids), None)
 
 			# Actual io metrics
 			svc_update = list()
@@ -266,16 +270,17 @@ class CGAcct(Collector):
 				try: delta = map(op.sub, res, cache_prev[k])
 				except KeyError: continue
 				delta_total = map(op.add, delta, delta_total)
-			for k,v in it.izip(['bytes_read', 'bytes_write', 'ops_read', 'ops_write'], delta_total):
-				yield Datapoint(_name(svc, k), 'gauge', v, None)
+			for k,v in it.izip([ 'io.bytes_read', 'io.bytes_write',
+					'io.ops_read', 'io.ops_write' ], delta_total):
+				yield Datapoint(names[k], 'gauge', v, None)
 			cache_update.update(svc_update)
 		_caches.append(cache_update)
 
 
 	def memory( self, services,
-			_name = 'processes.services.{}.memory.{}'.format ):
+			_names = _svc_names.__func__('processes.services.{}.memory.{}') ):
 		for svc, svc_instances in self._systemd_sticky_instances('memory', services):
-			vals = dict()
+			names, vals = _names[svc], dict()
 
 			for path in self._cg_svc_metrics('memory', 'stat', svc_instances):
 				try:
@@ -284,7 +289,7 @@ class CGAcct(Collector):
 							name, val = line.strip().split()
 							if not name.startswith('total_'): continue
 							name = name[6:]
-							val, k = int(val), ( _name(svc, name),
+							val, k = int(val), ( names[name],
 								'gauge' if not name.startswith('pg') else 'counter' )
 							if k not in vals: vals[k] = val
 							else: vals[k] += val
@@ -297,7 +302,7 @@ class CGAcct(Collector):
 				for path in self._cg_svc_metrics('memory', k, svc_instances):
 					try:
 						with self._cg_metric(path) as src:
-							vals[_name(svc, name), 'gauge'] = int(src.read().strip())
+							vals[names[name], 'gauge'] = int(src.read().strip())
 					except (OSError, IOError): pass
 
 			for (name, val_type), val in vals.viewitems():
@@ -6,7 +6,7 @@ from hashlib import sha256, sha512
 from base64 import b32decode
 from collections import defaultdict
 import os, sys, json, socket, time, types
-from . import Collector, Datapoint
+from . import Collector, Datapoint, NameCache
 
 import logging
 log = logging.getLogger(__name__)
@@ -206,7 +206,17 @@ class CjdnsPeerStats(Collector):
 		self.sock.connect(sock_addr)
 
 		self.admin_password = conf_admin['password']
-		self.peer_ipv6_cache = dict()
+		self.peer_ipv6_cache = NameCache(pubkey_to_ipv6, 2000)
+		self.peer_names = NameCache(self._peer_names, 2000)
+
+	def _peer_names(self, peer_id, direction=None):
+		'Returns (bytes_in, bytes_out, link) metric names for peer, last one can be None.'
+		name = '{}.{}.{{}}'.format(self.conf.prefix, peer_id)
+		if direction: name = name.format('{}_{{}}'.format(direction))
+		name_bytes = name.format('bytes_{}')
+		return name_bytes.format('in'), name_bytes.format('out'),\
+			name.format(self.conf.special_metrics.peer_link)\
+				if self.conf.special_metrics.peer_link else None
 
 	def get_stats_page(self, page, password, bs=2**30):
 		try:
@@ -287,25 +297,22 @@ class CjdnsPeerStats(Collector):
 			if pubkey.endswith('.k'): pubkey = pubkey[:-2]
 			peer['pubkey'] = pubkey
 			if 'ipv6' in self.conf.peer_id:
-				if pubkey not in self.peer_ipv6_cache:
-					self.peer_ipv6_cache[pubkey] = pubkey_to_ipv6(pubkey)
 				peer['ipv6'] = self.peer_ipv6_cache[pubkey]
 			for k in self.conf.peer_id:
 				if k in peer:
 					peer_id = peer[k]
 					break
 			else: raise KeyError(self.conf.peer_id, peer)
-			name = '{}.{}.{{}}'.format(self.conf.prefix, peer_id)
-			if peers_bidir[peer['publicKey']]:
-				name = name.format('incoming_{}' if peer['isIncoming'] else 'outgoing_{}')
+			direction = None if not peers_bidir[peer['publicKey']]\
+				else ('incoming' if peer['isIncoming'] else 'outgoing')
+			name_in, name_out, name_link = self.peer_names[peer_id, direction]
 
 			# Per-peer metrics
-			name_bytes = name.format('bytes_{}')
-			for k, d in [('bytesIn', 'in'), ('bytesOut', 'out')]:
-				yield Datapoint(name_bytes.format(d), 'counter', peer[k], ts)
-			if self.conf.special_metrics.peer_link:
+			yield Datapoint(name_in, 'counter', peer['bytesIn'], ts)
+			yield Datapoint(name_out, 'counter', peer['bytesOut'], ts)
+			if name_link:
 				link = 1 if state == 'established' else 0
-				yield Datapoint(name.format(self.conf.special_metrics.peer_link), 'gauge', link, ts)
+				yield Datapoint(name_link, 'gauge', link, ts)
 
 		# Common metrics
 		if self.conf.special_metrics.count:
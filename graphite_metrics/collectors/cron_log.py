@@ -3,7 +3,7 @@
 import itertools as it, operator as op, functools as ft
 import re, iso8601, calendar
 
-from . import Collector, Datapoint
+from . import Collector, Datapoint, TimestampParser
 
 import logging
 log = logging.getLogger(__name__)
@@ -138,6 +138,8 @@ def file_follow_durable( path,
 class CronJobs(Collector):
 
 	lines, aliases = dict(), list()
+	_ts_parse = TimestampParser( ['iso8601'],
+		fallback=lambda ts: calendar.timegm(iso8601.parse_date(ts).utctimetuple()) )
 
 	def __init__(self, *argz, **kwz):
 		super(CronJobs, self).__init__(*argz, **kwz)
@@ -166,7 +168,7 @@ class CronJobs(Collector):
 			for line in iter(self.log_tailer.next, u''):
 				# log.debug('LINE: {!r}'.format(line))
 				ts, line = line.strip().split(None, 1)
-				ts = calendar.timegm(iso8601.parse_date(ts).utctimetuple())
+				ts = self._ts_parse(ts)
 				matched = False
 				for ev, regex in self.lines.viewitems():
 					if not regex: continue
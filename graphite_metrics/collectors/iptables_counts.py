@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
-from subprocess import Popen, PIPE
+from subprocess import PIPE
 from collections import namedtuple, defaultdict
 from io import open
 import os, errno
@@ -79,7 +79,7 @@ class IPTables(Collector):
 			hash_new = hashes[v]
 
 			# iptables-save invocation and output processing loop
-			proc = Popen([self.iptables[v], '-c'], stdout=PIPE)
+			proc = self.popen([self.iptables[v], '-c'], stdout=PIPE)
 			chain_counts = defaultdict(int)
 			for line in it.imap(op.methodcaller('strip'), proc.stdout):
 				if line[0] != '[': # chain/table spec or comment
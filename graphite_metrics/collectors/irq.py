@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
-from io import open
+from glob import iglob
+import os, re, types
 
-from . import Collector, Datapoint
+from . import Collector, DatapointBatch, NameCache, numpy
 
 import logging
 log = logging.getLogger(__name__)
@@ -11,34 +12,151 @@ log = logging.getLogger(__name__)
 
 class IRQ(Collector):
 
+	'''Interrupt counters from /proc/interrupts and /proc/softirqs.
+		Per-cpu counters can be aggregated (see "aggregate" in config) as:
+			cpu - counter for each irq and cpu (irq.<irq>.cpu<n>), default.
+			node - sum for each irq and NUMA node (irq.<irq>.node<n>).
+			total - sum for each irq over all cpus (irq.<irq>.total).
+				Counters that are not per-cpu (e.g. ERR, MIS) are only reported
+				as totals in "node" mode too, as they can't be split by node.
+			top - same as "cpu", but only for "top_cpus" cpus
+				with the most interrupts of each irq since the last poll.
+		Tables are parsed via numpy, if it is available.'''
+
+	aggregate_modes = 'cpu', 'node', 'total', 'top'
+
+	_names = NameCache( lambda irq, bindings, count:
+		list('{}.{}'.format(irq, bind) for bind in bindings[:count]) )
+	_names_agg = NameCache(lambda irq, labels: list('{}.{}'.format(irq, k) for k in labels))
+
+	def __init__(self, *argz, **kwz):
+		super(IRQ, self).__init__(*argz, **kwz)
+		modes = self.conf.get('aggregate') or ['cpu']
+		if isinstance(modes, types.StringTypes): modes = [modes]
+		for mode in modes:
+			if mode not in self.aggregate_modes:
+				raise ValueError('Unknown irq aggregation mode: {!r}'.format(mode))
+		if 'cpu' in modes and 'top' in modes:
+			log.warn('Both "cpu" and "top" irq aggregation modes are enabled, ignoring "top"')
+			modes = list(mode for mode in modes if mode != 'top')
+		self.modes, self.top_cpus = modes, self.conf.get('top_cpus') or 8
+		self.cpu_nodes = self._cpu_nodes() if 'node' in modes else None
+		self._tables_prev = dict() # path: (bindings, irqs, table), for "top" mode
+
 	@staticmethod
-	def _parse_irq_table(table):
-		irqs = dict()
-		bindings = map(bytes.lower, table.readline().strip().split())
+	def _cpu_nodes(sysfs_path='/sys/devices/system/node'):
+		'Returns dict of {cpu_binding: node_n}, e.g. {"cpu3": 0, "cpu70": 1, ...}.'
+		cpu_nodes = dict()
+		for path in iglob(os.path.join(sysfs_path, 'node*/cpulist')):
+			node = int(re.search(r'/node(\d+)/', path).group(1))
+			with open(path, 'rb') as src: cpulist = src.read().strip()
+			for span in filter(None, cpulist.split(',')):
+				a, b = map(int, span.split('-', 1)) if '-' in span else [int(span)]*2
+				for n in xrange(a, b + 1): cpu_nodes['cpu{}'.format(n)] = node
+		if not cpu_nodes:
+			log.warn('Failed to get cpu-to-NUMA-node mapping, assuming single node')
+		return cpu_nodes
+
+	@staticmethod
+	def _parse_irq_table(lines):
+		'''Returns (bindings, irqs, widths, table), where "table" has zero-padded
+				row of per-binding counts for each irq (in the same order as "irqs" list),
+				and "widths" - number of counts actually present in each row (e.g. 1 for ERR/MIS).
+			Table is a 2d array, if numpy is available, and list of lists otherwise.'''
+		lines = iter(lines)
+		bindings = tuple(map(bytes.lower, next(lines).strip().split()))
 		bindings_cnt = len(bindings)
-		for line in it.imap(bytes.strip, table):
-			irq, line = line.split(None, 1)
-			irq = irq.rstrip(':').lower()
-			if irq in irqs:
+		irqs, widths, rows, irqs_set = list(), list(), list(), set()
+		for line in lines:
+			irq, line = line.split(':', 1)
+			irq = irq.strip().lower()
+			if irq in irqs_set:
 				log.warn('Conflicting irq name/id: {!r}, skipping'.format(irq))
 				continue
-			irqs[irq] = map(int, line.split(None, bindings_cnt)[:bindings_cnt])
-		return bindings, irqs
+			irqs_set.add(irq)
+			if numpy is not None:
+				# Parsing stops at the first non-number, i.e. irq description
+				try: row = numpy.fromstring(line, dtype=numpy.int64, sep=' ')[:bindings_cnt]
+				except ValueError: row = None
+			if numpy is None or row is None:
+				row = map(int, line.split(None, bindings_cnt)[:bindings_cnt])
+			irqs.append(irq)
+			widths.append(len(row))
+			rows.append(row)
+		if numpy is not None:
+			table = numpy.zeros((len(rows), bindings_cnt), dtype=numpy.int64)
+			for n, row in enumerate(rows): table[n, :len(row)] = row
+		else:
+			table = list( (row + [0] * (bindings_cnt - len(row)))
+				if len(row) < bindings_cnt else row for row in rows )
+		return bindings, irqs, widths, table
+
+	def _aggregate(self, bindings, table, mode):
+		'''Returns (labels, sums) for node/total aggregation modes, where
+			"sums" are rows of sums for each label, in the same order as table rows.'''
+		if mode == 'total':
+			labels, groups = ['total'], [range(len(bindings))]
+		elif mode == 'node':
+			nodes = dict()
+			for n, bind in enumerate(bindings):
+				nodes.setdefault(self.cpu_nodes.get(bind, 0), list()).append(n)
+			labels, groups = list(), list()
+			for node, cols in sorted(nodes.viewitems()):
+				labels.append('node{}'.format(node))
+				groups.append(cols)
+		if numpy is not None:
+			sums = numpy.column_stack(list(table[:, cols].sum(1) for cols in groups))
+		else:
+			sums = list(list(sum(row[n] for n in cols) for cols in groups) for row in table)
+		return tuple(labels), sums
+
+	def _top(self, path, bindings, irqs, table):
+		'''Returns list of column indexes for "top_cpus" cpus
+			with most interrupts since last poll (or boot, if it's the first one) for each row.'''
+		table_prev = self._tables_prev.get(path)
+		self._tables_prev[path] = bindings, irqs, table
+		if table_prev and table_prev[:2] == (bindings, irqs):
+			table_prev = table_prev[2]
+			if numpy is not None: table = table - table_prev
+			else: table = list(map(op.sub, row, row_prev) for row, row_prev in it.izip(table, table_prev))
+		k = self.top_cpus
+		if k >= len(bindings): return list(it.repeat(range(len(bindings)), len(table)))
+		if numpy is not None:
+			return numpy.sort(numpy.argpartition(-table, k - 1, axis=1)[:, :k], axis=1).tolist()
+		return list( sorted(sorted(xrange(len(row)), key=row.__getitem__, reverse=True)[:k])
+			for row in table )
 
 	def read(self):
-		irq_tables = list()
-		# /proc/interrupts
-		with open('/proc/interrupts', 'rb') as table:
-			irq_tables.append(self._parse_irq_table(table))
-		# /proc/softirqs
-		with open('/proc/softirqs', 'rb') as table:
-			irq_tables.append(self._parse_irq_table(table))
-		# dispatch
-		for bindings, irqs in irq_tables:
-			for irq, counts in irqs.viewitems():
-				if sum(counts) == 0: continue
-				for bind, count in it.izip(bindings, counts):
-					yield Datapoint('irq.{}.{}'.format(irq, bind), 'counter', count, None)
+		for path in '/proc/interrupts', '/proc/softirqs':
+			snap = self.snapshot(path)
+			bindings, irqs, widths, table = self._parse_irq_table(snap.lines())
+			if numpy is not None: active = numpy.flatnonzero(table.any(1)).tolist()
+			else: active = list(n for n, row in enumerate(table) if any(row))
+			names, values = list(), list() # values are rows or parts of these
+			for mode in self.modes:
+				if mode == 'cpu':
+					for n in active:
+						names.extend(self._names[irqs[n], bindings, widths[n]])
+						values.append(table[n][:widths[n]])
+				elif mode == 'top':
+					top = self._top(path, bindings, irqs, table)
+					for n in active:
+						cols = list(c for c in top[n] if c < widths[n])
+						names.extend(self._names[irqs[n], tuple(bindings[c] for c in cols), len(cols)])
+						values.append(list(table[n][c] for c in cols))
+				else:
+					labels, sums = self._aggregate(bindings, table, mode)
+					for n in active:
+						if mode == 'node' and widths[n] < len(bindings):
+							if 'total' in self.modes: continue # reported there
+							names.extend(self._names_agg[irqs[n], ('total',)])
+							values.append([sum(table[n][:widths[n]])])
+							continue
+						names.extend(self._names_agg[irqs[n], labels])
+						values.append(sums[n])
+			values = numpy.concatenate(values).tolist()\
+				if numpy is not None and values else list(it.chain.from_iterable(values))
+			yield DatapointBatch(names, 'counter', values, snap.ts, prefix='irq.')
 
 
 collector = IRQ
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
-from io import open
+from time import time
 import re
 
 from . import Collector, Datapoint, page_size_kb
@@ -12,6 +12,33 @@ log = logging.getLogger(__name__)
 
 class MemFrag(Collector):
 
+	'''Reading /proc/pagetypeinfo can be expensive on hosts with a lot of RAM,
+			as kernel holds zone locks while generating it, so it is read less often,
+			if read time exceeds "max_load" fraction of time since the last read,
+			up to "max_interval" seconds between reads. /proc/buddyinfo is read on every poll.
+		Time (seconds) spent reading each file is reported as
+			memory.fragmentation.read_cost.{buddyinfo,pagetypeinfo} gauges.'''
+
+	def __init__(self, *argz, **kwz):
+		super(MemFrag, self).__init__(*argz, **kwz)
+		self._ts_next = dict() # path: ts when it should be read next time
+
+	def _snapshot(self, path, adaptive=False):
+		'''Returns (snapshot, read_cost) for path or (None, None)
+			if reading it should be skipped until later (adaptive=True only).
+			read_cost is None if snapshot was taken by some other collector this cycle.'''
+		ts = time()
+		if adaptive and ts < self._ts_next.get(path, 0): return None, None
+		snap = self.snapshot(path)
+		if snap.ts < ts: return snap, None # cached
+		cost = time() - ts
+		if adaptive:
+			max_load = self.conf.get('max_load')
+			interval = cost / max_load if max_load else 0
+			if self.conf.get('max_interval'): interval = min(interval, self.conf.max_interval)
+			self._ts_next[path] = ts + interval
+		return snap, cost
+
 	def read( self,
 			_re_buddyinfo=re.compile(r'^\s*Node\s+(?P<node>\d+)'
 				r',\s+zone\s+(?P<zone>\S+)\s+(?P<counts>.*)$'),
@@ -20,50 +47,55 @@ class MemFrag(Collector):
 		mmap, pskb = dict(), page_size_kb
 
 		# /proc/buddyinfo
-		with open('/proc/buddyinfo', 'rb') as table:
-			for line in it.imap(bytes.strip, table):
-				match = _re_buddyinfo.search(line)
-				if not match:
-					log.warn('Unrecognized line in /proc/buddyinfo, skipping: {!r}'.format(line))
-					continue
-				node, zone = int(match.group('node')), match.group('zone').lower()
-				counts = dict( ('{}k'.format(pskb*2**order),count)
-					for order,count in enumerate(it.imap(int, match.group('counts').strip().split())) )
-				if node not in mmap: mmap[node] = dict()
-				if zone not in mmap[node]: mmap[node][zone] = dict()
-				mmap[node][zone]['available'] = counts
+		snap, cost = self._snapshot('/proc/buddyinfo')
+		if cost is not None:
+			yield Datapoint('memory.fragmentation.read_cost.buddyinfo', 'gauge', cost, snap.ts)
+		ts_buddyinfo = snap.ts
+		for line in it.imap(bytes.strip, snap.lines()):
+			match = _re_buddyinfo.search(line)
+			if not match:
+				log.warn('Unrecognized line in /proc/buddyinfo, skipping: {!r}'.format(line))
+				continue
+			node, zone = int(match.group('node')), match.group('zone').lower()
+			counts = dict( ('{}k'.format(pskb*2**order),count)
+				for order,count in enumerate(it.imap(int, match.group('counts').strip().split())) )
+			if node not in mmap: mmap[node] = dict()
+			if zone not in mmap[node]: mmap[node][zone] = dict()
+			mmap[node][zone]['available'] = counts
 
 		# /proc/pagetypeinfo
-		with open('/proc/pagetypeinfo', 'rb') as table:
-			page_counts_found = False
-			while True:
-				line = table.readline()
-				if not line: break
-				elif 'Free pages count' not in line:
-					while line.strip(): line = table.readline()
-					continue
-				elif page_counts_found:
-					log.warn( 'More than one free pages'
-						' counters section found in /proc/pagetypeinfo' )
-					continue
-				else:
-					page_counts_found = True
-					for line in it.imap(bytes.strip, table):
-						if not line: break
-						match = _re_ptinfo.search(line)
-						if not match:
-							log.warn( 'Unrecognized line'
-								' in /proc/pagetypeinfo, skipping: {!r}'.format(line) )
-							continue
-						node, zone, mtype = int(match.group('node')),\
-							match.group('zone').lower(), match.group('mtype').lower()
-						counts = dict( ('{}k'.format(pskb*2**order),count)
-							for order,count in enumerate(it.imap(int, match.group('counts').strip().split())) )
-						if node not in mmap: mmap[node] = dict()
-						if zone not in mmap[node]: mmap[node][zone] = dict()
-						mmap[node][zone][mtype] = counts
-			if not page_counts_found:
-				log.warn('Failed to find free pages counters in /proc/pagetypeinfo')
+		snap, cost = self._snapshot('/proc/pagetypeinfo', adaptive=True)
+		if cost is not None:
+			yield Datapoint('memory.fragmentation.read_cost.pagetypeinfo', 'gauge', cost, snap.ts)
+		table, page_counts_found = iter(snap.lines() if snap else list()), False
+		while True:
+			line = next(table, None)
+			if line is None: break
+			elif 'Free pages count' not in line:
+				while line and line.strip(): line = next(table, None)
+				continue
+			elif page_counts_found:
+				log.warn( 'More than one free pages'
+					' counters section found in /proc/pagetypeinfo' )
+				continue
+			else:
+				page_counts_found = True
+				for line in it.imap(bytes.strip, table):
+					if not line: break
+					match = _re_ptinfo.search(line)
+					if not match:
+						log.warn( 'Unrecognized line'
+							' in /proc/pagetypeinfo, skipping: {!r}'.format(line) )
+						continue
+					node, zone, mtype = int(match.group('node')),\
+						match.group('zone').lower(), match.group('mtype').lower()
+					counts = dict( ('{}k'.format(pskb*2**order),count)
+						for order,count in enumerate(it.imap(int, match.group('counts').strip().split())) )
+					if node not in mmap: mmap[node] = dict()
+					if zone not in mmap[node]: mmap[node][zone] = dict()
+					mmap[node][zone][mtype] = counts
+		if snap and not page_counts_found:
+			log.warn('Failed to find free pages counters in /proc/pagetypeinfo')
 
 		# Dispatch values from mmap
 		for node,zones in mmap.viewitems():
@@ -74,7 +106,7 @@ class MemFrag(Collector):
 						yield Datapoint( 'memory.fragmentation.{}'\
 								.format('.'.join(it.imap( bytes,
 									['node_{}'.format(node),zone,mtype,size] ))),
-							'gauge', count, None )
+							'gauge', count, ts_buddyinfo if mtype == 'available' else snap.ts )
 
 
 collector = MemFrag
@@ -3,7 +3,7 @@
 import itertools as it, operator as op, functools as ft
 import re
 
-from . import Collector, Datapoint
+from . import Collector, Datapoint, DatapointBatch, NameCache
 
 import logging
 log = logging.getLogger(__name__)
@@ -21,21 +21,36 @@ class MemStats(Collector):
 		return _re3.sub('_', _re2.sub(
 			r'\1_\2', _re1.sub(r'\1_\2', name) )).lower()
 
+	@staticmethod
+	def _meminfo_name(metric):
+		'Returns (mangled key, metric name) for /proc/meminfo key or None to skip it.'
+		if metric.startswith('DirectMap'): return # static info
+		metric = MemStats._camelcase_fix(
+			metric.rstrip(':').replace('(', '_').replace(')', '') )
+		if metric.startswith('s_'): metric = 'slab_{}'.format(metric[2:])
+		elif metric.startswith('mem_'): metric = metric[4:]
+		elif metric == 'slab': metric = 'slab_total'
+		return metric, 'memory.allocation.{}'.format(metric)
+
+	_meminfo_names = NameCache(_meminfo_name.__func__, 1000)
+
 	def read(self):
 		# /proc/vmstat
-		with open('/proc/vmstat', 'rb') as table:
-			for line in table:
-				metric, val = line.strip().split(None, 1)
-				val = int(val)
-				if metric.startswith('nr_'):
-					yield Datapoint( 'memory.pages.allocation.{}'\
-						.format(metric[3:]), 'gauge', val, None )
-				else:
-					yield Datapoint( 'memory.pages.activity.{}'\
-						.format(metric), 'gauge', val, None )
+		allocation, activity = list(), list()
+		snap = self.snapshot('/proc/vmstat')
+		for line in snap.lines():
+			metric, val = line.split(None, 1)
+			if metric.startswith('nr_'): allocation.append((metric[3:], int(val)))
+			else: activity.append((metric, int(val)))
+		for prefix, data in [
+				('memory.pages.allocation.', allocation),
+				('memory.pages.activity.', activity) ]:
+			if not data: continue
+			names, values = map(list, it.izip(*data))
+			yield DatapointBatch(names, 'gauge', values, snap.ts, prefix=prefix)
 		# /proc/meminfo
-		with open('/proc/meminfo', 'rb') as table:
-			table = dict(line.strip().split(None, 1) for line in table)
+		snap = self.snapshot('/proc/meminfo')
+		table = dict(line.split(None, 1) for line in snap.lines())
 		hp_size = table.pop('Hugepagesize:', None)
 		if hp_size and not hp_size.endswith(' kB'): hp_size = None
 		if hp_size: hp_size = int(hp_size[:-3])
@@ -43,13 +58,9 @@ class MemStats(Collector):
 			log.warn('Unable to get hugepage size from /proc/meminfo')
 			self._warn_hp = False
 		for metric, val in table.viewitems():
-			if metric.startswith('DirectMap'): continue # static info
-			# Name mangling
-			metric = self._camelcase_fix(
-				metric.rstrip(':').replace('(', '_').replace(')', '') )
-			if metric.startswith('s_'): metric = 'slab_{}'.format(metric[2:])
-			elif metric.startswith('mem_'): metric = metric[4:]
-			elif metric == 'slab': metric = 'slab_total'
+			names = self._meminfo_names[metric]
+			if not names: continue
+			metric, name = names
 			# Value processing
 			try: val, val_unit = val.split()
 			except ValueError: # no units assumed as number of pages
@@ -63,8 +74,7 @@ class MemStats(Collector):
 					log.warn('Unhandled unit type in /etc/meminfo: {}'.format(unit))
 					continue
 				val = int(val)
-			yield Datapoint( 'memory.allocation.{}'\
-				.format(metric), 'gauge', val * 1024, None )
+			yield Datapoint(name, 'gauge', val * 1024, snap.ts)
 
 
 collector = MemStats
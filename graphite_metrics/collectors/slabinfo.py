@@ -3,8 +3,9 @@
 import itertools as it, operator as op, functools as ft
 from collections import namedtuple
 from io import open
+import re
 
-from . import Collector, Datapoint, page_size
+from . import Collector, Datapoint, NameCache, page_size
 
 import logging
 log = logging.getLogger(__name__)
@@ -12,13 +13,23 @@ log = logging.getLogger(__name__)
 
 class SlabInfo(Collector):
 
+	'''Slab cache sizes from /proc/slabinfo, filtered by include/exclude prefixes.
+		If "top_n" option is set, only that many caches with most allocated bytes
+			are reported, with the rest of them summed into "memory.slabs.other.*" gauges.'''
+
 	version_check = '2.1'
+	val_names = 'obj_active', 'slab_active', 'slab_allocated'
 
 	def __init__(self, *argz, **kwz):
 		super(SlabInfo, self).__init__(*argz, **kwz)
 
 		for k in 'include_prefixes', 'exclude_prefixes':
 			if not self.conf.get(k): self.conf[k] = list()
+		self._names = NameCache(self._slab_names, 5000)
+		# Single anchored regexp for both lists, include ones matched first
+		self._filter = re.compile(r'^(?:({})|({}))'.format(*(
+			'|'.join(map(re.escape, self.conf[k])) or '(?!)'
+			for k in ['include_prefixes', 'exclude_prefixes'] ))).match
 
 		with open('/proc/slabinfo', 'rb') as table:
 			line = table.readline()
@@ -41,29 +52,35 @@ class SlabInfo(Collector):
 			self.parse_line = lambda line: record(*( (int(val) if idx else val)
 					for idx,val in enumerate(picker(line.strip().split())) ))
 
+	def _slab_names(self, name):
+		'Returns tuple of metric names for slab cache or None, if it is filtered-out.'
+		match = self._filter(name)
+		if match and match.group(2) is not None: return None
+		return tuple( 'memory.slabs.{}.bytes_{}'
+			.format(name, val_name) for val_name in self.val_names )
+
 	# http://elinux.org/Slab_allocator
 	def read(self):
 		parse_line, ps = self.parse_line, page_size
-		with open('/proc/slabinfo', 'rb') as table:
-			table.readline(), table.readline() # header
-			for line in table:
-				info = parse_line(line)
-				for prefix in self.conf.include_prefixes:
-					if info.name.startswith(prefix): break # force-include
-				else:
-					for prefix in self.conf.exclude_prefixes:
-						if info.name.startswith(prefix):
-							info = None
-							break
-				if info:
-					vals = [
-						('obj_active', info.active_objs * info.objsize),
-						('slab_active', info.active_slabs * info.pagesperslab * ps),
-						('slab_allocated', info.num_slabs * info.pagesperslab * ps) ]
-					if self.conf.pass_zeroes or sum(it.imap(op.itemgetter(1), vals)) != 0:
-						for val_name, val in vals:
-							yield Datapoint( 'memory.slabs.{}.bytes_{}'\
-								.format(info.name, val_name), 'gauge', val, None )
+		snap = self.snapshot('/proc/slabinfo')
+		slabs = list()
+		for line in it.islice(snap.lines(), 2, None): # skip header
+			names = self._names[line.split(None, 1)[0]]
+			if not names: continue
+			info = parse_line(line)
+			vals = [ info.active_objs * info.objsize,
+				info.active_slabs * info.pagesperslab * ps,
+				info.num_slabs * info.pagesperslab * ps ]
+			if self.conf.pass_zeroes or sum(vals) != 0: slabs.append((names, vals))
+		top_n = self.conf.get('top_n')
+		if top_n and len(slabs) > top_n:
+			slabs.sort(key=lambda (names, vals): vals[2], reverse=True)
+			slabs, other = slabs[:top_n], slabs[top_n:]
+			slabs.append(( tuple( 'memory.slabs.other.bytes_{}'.format(val_name)
+				for val_name in self.val_names ), map(sum, it.izip(*it.imap(op.itemgetter(1), other))) ))
+		for names, vals in slabs:
+			for name, val in it.izip(names, vals):
+				yield Datapoint(name, 'gauge', val, snap.ts)
 
 
 collector = SlabInfo
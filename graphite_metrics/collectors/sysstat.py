@@ -1,36 +1,184 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
-from subprocess import Popen, PIPE, STDOUT
-from time import time, sleep, strptime, mktime
-from calendar import timegm
+from collections import namedtuple
+from subprocess import PIPE, STDOUT
+from time import time, sleep, mktime
 from datetime import datetime, timedelta
 from xattr import xattr
-import os, sys, socket, struct
+import os, sys, io, socket, struct, signal
 
-from . import Collector, Datapoint, dev_resolve, sector_bytes, rate_limit
+from . import Collector, Datapoint, DatapointStream,\
+	TimestampParser, dev_resolve, sector_bytes, rate_limit, backpressure
 
-try: from simplejson import loads, dumps, JSONDecodeError
-except ImportError:
-	from json import loads, dumps
-	JSONDecodeError = ValueError
+try: from simplejson import JSONDecoder
+except ImportError: from json import JSONDecoder
 
 import logging
 log = logging.getLogger(__name__)
 
 
+SAJob = namedtuple('SAJob', 'path day cmd ts_from size xattr')
+
+
+class ChildLog(object):
+
+	'''Replacement for module logger in forked child processes, passing messages
+			to the parent as DatapointStream error-markers, to be logged there.
+		Child can't use logging module itself, as its locks
+			can be held by other threads of the parent at the time of fork.'''
+
+	def __init__(self, dst): self.dst = dst
+
+	def log(self, level, msg):
+		self.dst.write_marker(self.dst.flag_error, '{} {}'.format(level, msg))
+
+	def debug(self, msg): self.log(logging.DEBUG, msg)
+	def info(self, msg): self.log(logging.INFO, msg)
+	def warn(self, msg): self.log(logging.WARNING, msg)
+	def error(self, msg): self.log(logging.ERROR, msg)
+	def exception(self, msg):
+		from traceback import format_exc
+		self.log(logging.ERROR, '{}\n{}'.format(msg, format_exc().rstrip()))
+	warning = warn
+
+
+class ChildOutput(object):
+
+	'''Buffered file-like reader for output of a forked child process
+			from a pipe (fd) or a spool file, following it as it's being written.
+		read() only returns less data than requested (at EOF) after
+			"running" callback returns False, i.e. child has exited or got killed.'''
+
+	def __init__(self, src, running, bufsize=2**16, poll_interval=0.1):
+		self.src, self.running, self.bufsize, self.poll_interval = src, running, bufsize, poll_interval
+		self.pipe = isinstance(src, (int, long))
+		self.buff, self.pos, self.eof = '', 0, False
+
+	def _read(self):
+		'Returns next chunk of data, empty string if there is none yet or None on EOF.'
+		if self.pipe:
+			from select import select
+			if select([self.src], [], [], self.poll_interval)[0]:
+				return os.read(self.src, self.bufsize) or None
+			self.running() # to check deadline
+			return ''
+		chunk = self.src.read(self.bufsize)
+		if chunk: return chunk
+		if not self.running(): return self.src.read() or None
+		sleep(self.poll_interval)
+		return ''
+
+	def read(self, n):
+		while len(self.buff) - self.pos < n and not self.eof:
+			chunk = self._read()
+			if chunk is None: self.eof = True
+			elif chunk: self.buff, self.pos = self.buff[self.pos:] + chunk, 0
+		data = self.buff[self.pos:self.pos + n]
+		self.pos += len(data)
+		return data
+
+	def close(self):
+		if self.pipe: os.close(self.src)
+		else: self.src.close()
+
+
+class JSONStream(object):
+
+	'''Minimal pull-parser for large json documents, read from file-like
+			object incrementally, where only the structure around values of interest
+			is parsed here, and these values are decoded one at a time via raw_decode.
+		Usage example, to process items in {"list": [...], ...} one-by-one:
+			for k in stream.members():
+				if k != 'list': stream.value() # skip
+				else:
+					for n in stream.items(): process(stream.value())
+		Loop body must consume each value (via value() or nested members/items),
+			so that only one of these is in memory at a time (along with read buffer).'''
+
+	ws = ' \t\n\r'
+
+	def __init__(self, src, bufsize=2**16):
+		self.src, self.bufsize, self.eof = src, bufsize, False
+		self.buff, self.pos = '', 0
+		self.decode = JSONDecoder().raw_decode
+
+	def _fill(self):
+		if self.eof: return False
+		# Read size is doubled for large values to avoid re-parsing these many times
+		chunk = self.src.read(max(self.bufsize, len(self.buff) - self.pos))
+		if not chunk: self.eof = True
+		self.buff, self.pos = self.buff[self.pos:] + chunk, 0
+		return True
+
+	def peek(self):
+		'Returns next non-whitespace char without consuming it, or None on EOF.'
+		while True:
+			buff, pos, ws = self.buff, self.pos, self.ws
+			while pos < len(buff) and buff[pos] in ws: pos += 1
+			self.pos = pos
+			if pos < len(buff): return buff[pos]
+			if not self._fill(): return None
+
+	def take(self, chars):
+		c = self.peek()
+		if c is None or c not in chars:
+			raise ValueError('Expected one of {!r} in json stream, got {!r}'.format(chars, c))
+		self.pos += 1
+		return c
+
+	def value(self):
+		'Decodes and returns next json value.'
+		self.peek()
+		while True:
+			try: val, pos = self.decode(self.buff, self.pos)
+			except ValueError:
+				if not self._fill(): raise
+				continue
+			# Number at the end of a buffer can be cut short
+			if pos == len(self.buff) and self._fill(): continue
+			self.pos = pos
+			return val
+
+	def members(self):
+		'Yields keys of the next object, its values must be consumed before next iteration.'
+		self.take('{')
+		if self.peek() == '}': self.pos += 1
+		else:
+			while True:
+				key = self.value()
+				self.take(':')
+				yield key
+				if self.take(',}') == '}': break
+
+	def items(self):
+		'Yields indexes of the next array, its items must be consumed before next iteration.'
+		self.take('[')
+		if self.peek() == ']': self.pos += 1
+		else:
+			for n in it.count():
+				yield n
+				if self.take(',]') == ']': break
+
+
 class SADF(Collector):
 
+	xattr_pos = struct.Struct('=I') # timestamp, in xattr_name
+	xattr_size = struct.Struct('=Q') # sa file size, in xattr_size_name
+	_ts_parse = TimestampParser(['sysstat'])
+
 
 	def __init__(self, *argz, **kwz):
 		super(SADF, self).__init__(*argz, **kwz)
 
+		try:
+			from . import cfg
+			interval = cfg.loop.interval
+		except (ImportError, KeyError, AttributeError): interval = None
+
 		# Set force_interval margins, if used
 		if self.conf.force_interval:
-			try:
-				from . import cfg
-				interval = cfg.loop.interval
-			except (ImportError, KeyError, AttributeError):
+			if interval is None:
 				log.warn( 'Failed to apply force_interval option'
 					' - unable to access global configuration to get data collection interval' )
 				self.force_interval = None
@@ -45,6 +193,8 @@ class SADF(Collector):
 				max_interval=self.conf.rate.max_interval,
 				sampling=self.conf.rate.sampling )\
 			if self.conf.rate.limiting_enabled else None
+		self._backfill_ts, self._backfill_interval = None, interval # for backfill.max_rate
+		self._sa_children, self._sa_cancelled = set(), False # forked backfill_workers, see cancel()
 
 
 	def process_entry(self, entry):
@@ -56,13 +206,8 @@ class SADF(Collector):
 				' without timestamp, skipping: {!r}'.format(entry) )
 			return # happens, no idea what to do with these
 		interval = ts['interval']
-		for fmt in '%Y-%m-%d %H-%M-%S', '%Y-%m-%d %H:%M:%S':
-			try:
-				ts = (mktime if not ts['utc'] else timegm)\
-					(strptime('{} {}'.format(ts['date'], ts['time']), fmt))
-			except ValueError: pass
-			else: break
-		else:
+		try: ts = self._ts_parse('{} {}'.format(ts['date'], ts['time']), utc=ts['utc'])
+		except ValueError:
 			raise ValueError( 'Unable to process'
 				' sysstat timestamp: {!r} {!r}'.format(ts['date'], ts['time']) )
 
@@ -187,7 +332,33 @@ class SADF(Collector):
 		return ts, interval, metrics
 
 
-	def _read(self, ts_to=None):
+	def _sadf_samples(self, src, host):
+		'''Parses "sadf -j" output from src incrementally, yielding
+			process_entry() results for each entry in "statistics" lists,
+			so that only one such entry is decoded and kept in memory at a time.'''
+		stream = JSONStream(src)
+		for k in stream.members():
+			if k != 'sysstat': stream.value(); continue
+			for k in stream.members():
+				if k != 'hosts': stream.value(); continue
+				for n in stream.items():
+					host_skip = False # sadf puts nodename before statistics
+					for k in stream.members():
+						if k == 'nodename':
+							nodename = stream.value()
+							if nodename != host:
+								log.warn( 'Mismatching hostname in sa data:'
+									' {} (uname: {}), skipping'.format(nodename, host) )
+								host_skip = True
+						elif k != 'statistics' or host_skip: stream.value()
+						else:
+							for n in stream.items():
+								sample = self.process_entry(stream.value())
+								if sample: yield sample
+
+	def _sa_jobs(self, ts_to=None):
+		'''Returns list of SAJob tuples for sa files with new data
+			to process, sorted by day, which are processed in that order.'''
 		if not ts_to: ts_to = datetime.now()
 
 		sa_days = dict( (ts.day, ts)
@@ -195,24 +366,27 @@ class SADF(Collector):
 			for i in xrange(self.conf.skip.older_than_days+1)) )
 		sa_files = sorted(it.ifilter(
 			op.methodcaller('startswith', 'sa'), os.listdir(self.conf.sa_path) ))
-		host = os.uname()[1] # to check vs nodename in data
 		log.debug('SA files to process: {}'.format(sa_files))
 
+		jobs = list()
 		for sa in sa_files:
 			sa_day = int(sa[2:])
 			try: sa_day = sa_days[sa_day]
 			except KeyError: continue # too old or new
 
 			sa = os.path.join(self.conf.sa_path, sa)
-			log.debug('Processing file: {}'.format(sa))
+			log.debug('Checking file: {}'.format(sa))
 
-			# Read xattr timestamp
-			sa_xattr = xattr(sa)
+			# Read xattr position - last timestamp and file size, if it was recorded
+			sa_xattr, sa_size = xattr(sa), None
 			try: sa_ts_from = sa_xattr[self.conf.xattr_name]
 			except KeyError: sa_ts_from = None
 			if sa_ts_from:
-				sa_ts_from = datetime.fromtimestamp(
-					struct.unpack('=I', sa_ts_from)[0] )
+				sa_ts_from, = self.xattr_pos.unpack(sa_ts_from[:self.xattr_pos.size])
+				sa_ts_from = datetime.fromtimestamp(sa_ts_from)
+				if self.conf.get('xattr_size_name'):
+					try: sa_size, = self.xattr_size.unpack(sa_xattr[self.conf.xattr_size_name])
+					except (KeyError, struct.error): pass
 				if sa_day - sa_ts_from > timedelta(1) + timedelta(seconds=60):
 					log.debug( 'Discarding xattr timestamp, because'
 						' it doesnt seem to belong to the same date as file'
@@ -221,6 +395,11 @@ class SADF(Collector):
 				if sa_ts_from and sa_ts_from.date() != sa_day.date():
 					log.debug('File xattr timestamp points to the next day, skipping file')
 					continue
+			# sadf has to scan whole file, so it's only run if new records were appended
+			sa_size_now = os.stat(sa).st_size
+			if sa_ts_from and sa_size == sa_size_now:
+				log.debug('No new records since last xattr position, skipping file')
+				continue
 			if not self.conf.max_dump_span: sa_ts_to = None
 			else:
 				# Use 00:00 of sa_day + max_dump_span if there's no xattr
@@ -229,61 +408,220 @@ class SADF(Collector):
 				# Avoid adding restrictions, if they make no sense anyway
 				if sa_ts_to >= datetime.now(): sa_ts_to = None
 
-			# Get data from sadf
 			sa_cmd = ['sadf', '-jt']
 			if sa_ts_from: sa_cmd.extend(['-s', sa_ts_from.strftime('%H:%M:%S')])
 			if sa_ts_to: sa_cmd.extend(['-e', sa_ts_to.strftime('%H:%M:%S')])
 			sa_cmd.extend(['--', '-A'])
 			sa_cmd.append(sa)
-			log.debug('sadf command: {}'.format(sa_cmd))
-			sa_proc = Popen(sa_cmd, stdout=PIPE)
-			try: data = loads(sa_proc.stdout.read())
-			except JSONDecodeError as err:
-				log.exception(( 'Failed to process sadf (file:'
-					' {}, command: {}) output: {}' ).format(sa, sa_cmd, err))
-				data = None
-			if sa_proc.wait():
-				log.error('sadf (command: {}) exited with error'.format(sa_cmd))
-				data = None
-			if not data:
-				log.warn('Skipping processing of sa file: {}'.format(sa))
-				continue
+			jobs.append(SAJob( sa, sa_day, sa_cmd,
+				sa_ts_from, sa_size_now if not sa_ts_to else 0, sa_xattr ))
 
-			# Process and dispatch the datapoints
-			sa_ts_max = 0
-			for data in data['sysstat']['hosts']:
-				if data['nodename'] != host:
-					log.warn( 'Mismatching hostname in sa data:'
-						' {} (uname: {}), skipping'.format(data['nodename'], host) )
+		return sorted(jobs, key=op.attrgetter('day'))
+
+	def _sa_read(self, job, res):
+		'''Yields datapoints for SAJob, setting "ts_max" (last processed timestamp)
+				and "done" (if all sadf output was processed without errors) keys in res dict.
+			If res has "budget" set, samples older than "ts_live" decrement it by a number
+				of values in these, and processing stops with "paused" set, once it's used up.'''
+		host = os.uname()[1] # to check vs nodename in data
+		log.debug('sadf command: {}'.format(job.cmd))
+		sa_proc = self.popen(job.cmd, stdout=PIPE)
+		sa_day_ts = mktime(job.day.timetuple())
+		res.update(ts_max=0, done=False, paused=False)
+		try:
+			for ts, interval, metrics in self._sadf_samples(sa_proc.stdout, host):
+				if res.get('budget') is not None and ts < res['ts_live']:
+					if res['budget'] <= 0:
+						res['paused'] = True
+						break
+					res['budget'] -= len(metrics)
+				if ts - 1 > res['ts_max']:
+					# has to be *before* beginning of the next interval
+					res['ts_max'] = ts - 1
+				if abs(ts - sa_day_ts) > 24*3600 + interval + 1:
+					log.warn( 'Dropping sample because of timestamp mismatch'
+						' (timestamp: {}, expected date: {})'.format(ts, sa_day_ts) )
 					continue
-				sa_day_ts = mktime(sa_day.timetuple())
-				# Read the data
-				for ts, interval, metrics in it.ifilter(
-						None, it.imap(self.process_entry, data['statistics']) ):
-					if ts - 1 > sa_ts_max:
-						# has to be *before* beginning of the next interval
-						sa_ts_max = ts - 1
-					if abs(ts - sa_day_ts) > 24*3600 + interval + 1:
-						log.warn( 'Dropping sample because of timestamp mismatch'
-							' (timestamp: {}, expected date: {})'.format(ts, sa_day_ts) )
-						continue
-					if self.force_interval and (
-							interval < self.force_interval[0]
-							or interval > self.force_interval[1] ):
-						log.warn( 'Dropping sample because of interval mismatch'
-							' (file: {sa}, interval: {interval},'
-							' required: {margins[0]}-{margins[1]}, timestamp: {ts})'\
-								.format(sa=sa, interval=interval, ts=ts, margins=self.force_interval) )
+				if self.force_interval and (
+						interval < self.force_interval[0]
+						or interval > self.force_interval[1] ):
+					log.warn( 'Dropping sample because of interval mismatch'
+						' (file: {sa}, interval: {interval},'
+						' required: {margins[0]}-{margins[1]}, timestamp: {ts})'\
+							.format(sa=job.path, interval=interval, ts=ts, margins=self.force_interval) )
+					continue
+				ts_val = int(ts)
+				for name, val in metrics:
+					yield Datapoint('.'.join(name), 'gauge', val, ts_val)
+			else: res['done'] = True
+		except ValueError as err:
+			log.exception(( 'Failed to process sadf (file:'
+				' {}, command: {}) output: {}' ).format(job.path, job.cmd, err))
+		finally:
+			if not res['done'] and sa_proc.poll() is None: # error or generator was closed
+				sa_proc.kill()
+				sa_proc.wait()
+		if sa_proc.wait() and res['done']:
+			log.error('sadf (command: {}) exited with error'.format(job.cmd))
+			res['done'] = False
+
+	def _sa_update(self, job, ts_max, done):
+		'''Updates xattr position for SAJob, if any entries were processed, recording
+			file size only if all records up to it were processed (no -e limit).'''
+		if not ts_max and job.ts_from and done:
+			ts_max = mktime(job.ts_from.timetuple()) # to record new size
+		if not ts_max: return
+		size = job.size if done else 0
+		log.debug('Updating xattr position for {} to {} (size: {})'.format(job.path, ts_max, size))
+		if not self.conf.debug.dry_run:
+			job.xattr[self.conf.xattr_name] = self.xattr_pos.pack(int(ts_max))
+			if self.conf.get('xattr_size_name'):
+				job.xattr[self.conf.xattr_size_name] = self.xattr_size.pack(size)
+
+	def _sa_read_forked(self, jobs, workers):
+		'''Processes SAJobs in up to "workers" forked child processes at once, yielding
+				datapoints from these in the same order as jobs, as they're being processed.
+			Children write DatapointStream frames to a pipe, if they're started as the first
+				job in line, or to a temporary file in backfill_spool_dir otherwise,
+				which is then read (following child process) after all previous jobs.
+			Children run in their own process groups (with sadf), and are killed along with
+				these if they don't finish within backfill_workers_timeout or on cancel().
+			Xattr position for each file is updated after all of its datapoints were yielded.'''
+		from tempfile import TemporaryFile
+		timeout, spool_dir = self.conf.get('backfill_workers_timeout'), self.conf.get('backfill_spool_dir')
+		jobs, running = list(jobs), list() # running: (job, pid, src, deadline), src - pipe fd or file
+		self._sa_cancelled = False
+		try:
+			while running or (jobs and not self._sa_cancelled):
+				while jobs and len(running) < workers and not self._sa_cancelled:
+					job = jobs.pop(0)
+					if not running: src, (pipe, dst) = None, os.pipe()
+					else: src = dst = TemporaryFile(prefix='harvestd.sysstat.', dir=spool_dir)
+					pid = os.fork()
+					if not pid:
+						try:
+							os.setpgrp()
+							if src is None:
+								os.close(pipe)
+								dst = os.fdopen(dst, 'wb')
+							global log
+							res, dst = dict(), DatapointStream(dst)
+							log = ChildLog(dst)
+							logging.disable(logging.CRITICAL) # any other loggers - no-op, without taking locks
+							for dp in self._sa_read(job, res): dst.write(dp)
+							dst.write_marker( dst.flag_end,
+								'{} {}'.format(res['ts_max'], int(res['done'])) )
+							dst.stream.flush()
+						finally: os._exit(0)
+					if src is None:
+						os.close(dst)
+						src = pipe
+					else: # separate file description, as offset is shared with child's one
+						src = io.open('/proc/self/fd/{}'.format(dst.fileno()), 'rb', buffering=0)
+						dst.close()
+					self._sa_children.add(pid)
+					running.append((job, pid, src, time() + timeout if timeout else None))
+				job, pid, src, deadline = running[0]
+				src = DatapointStream(ChildOutput(src, ft.partial(self._sa_child_poll, pid, deadline)))
+				done, ts_max = False, 0
+				while True:
+					try: frame = src.read()
+					except EOFError: frame = None
+					if not frame:
+						log.error('Unexpected EOF from sysstat child process for file: {}'.format(job.path))
+						break
+					if frame[0] & src.flag_end:
+						ts_max, done = frame[1].split()
+						ts_max, done = float(ts_max), bool(int(done))
+						break
+					if frame[0] & src.flag_error: # log message
+						level, msg = frame[1].split(' ', 1)
+						log.log(int(level), msg)
 						continue
-					ts_val = int(ts)
-					for name, val in metrics:
-						yield Datapoint('.'.join(name), 'gauge', val, ts_val)
-
-			# Update xattr timestamp, if any entries were processed
-			if sa_ts_max:
-				log.debug('Updating xattr timestamp to {}'.format(sa_ts_max))
-				if not self.conf.debug.dry_run:
-					sa_xattr[self.conf.xattr_name] = struct.pack('=I', int(sa_ts_max))
+					yield src.datapoint(frame)
+				running.pop(0)
+				src.stream.close()
+				self._sa_child_wait(pid)
+				self._sa_update(job, ts_max, done)
+		finally:
+			for job, pid, src, deadline in running:
+				self._sa_child_kill(pid)
+				self._sa_child_wait(pid)
+				if isinstance(src, (int, long)): os.close(src)
+				else: src.close()
+
+	def _sa_child_kill(self, pid):
+		try: os.killpg(pid, signal.SIGKILL)
+		except OSError: # setpgrp() might not have been called yet
+			try: os.kill(pid, signal.SIGKILL)
+			except OSError: pass
+
+	def _sa_child_poll(self, pid, deadline=None):
+		'''Returns True if forked child process is still running, reaping it otherwise,
+			or killing it (with its process group), if deadline (unix timestamp) was missed.'''
+		if pid not in self._sa_children: return False
+		if not os.waitpid(pid, os.WNOHANG)[0]:
+			if not deadline or time() <= deadline: return True
+			log.warn( 'Killing sysstat child process (pid: {}),'
+				' as it has missed its deadline (backfill_workers_timeout)'.format(pid) )
+			self._sa_child_kill(pid)
+			os.waitpid(pid, 0)
+		self._sa_children.discard(pid)
+		return False
+
+	def _sa_child_wait(self, pid):
+		if pid not in self._sa_children: return # already reaped
+		os.waitpid(pid, 0)
+		self._sa_children.discard(pid)
+
+	def cancel(self):
+		super(SADF, self).cancel()
+		self._sa_cancelled = True # don't start any new children
+		for pid in list(self._sa_children):
+			log.debug('Killing sysstat child process (pid: {})'.format(pid))
+			self._sa_child_kill(pid)
+
+	def _backfill_budget(self):
+		'''Returns max number of historical datapoints (older than backfill.live_window)
+			to emit on this run, or None if there are no limits on these.
+			Budget is reduced proportionally to sinks' backpressure level.'''
+		conf, ts = self.conf.backfill, time()
+		ts_last, self._backfill_ts = self._backfill_ts, ts
+		budget = list()
+		if conf.max_datapoints: budget.append(conf.max_datapoints)
+		if conf.max_rate:
+			if ts_last is None: # first run - one loop interval worth of datapoints
+				ts_last = ts - (self._backfill_interval or 60)
+			budget.append(int(conf.max_rate * (ts - ts_last)))
+		if not budget: return None
+		return int(min(budget) * (1 - backpressure.level))
+
+	def _read(self, ts_to=None):
+		jobs, budget = self._sa_jobs(ts_to), self._backfill_budget()
+		workers = self.conf.get('backfill_workers') or 1
+		if budget is None and workers > 1 and len(jobs) > 1:
+			for dp in self._sa_read_forked(jobs, workers): yield dp
+			return
+
+		res = dict(budget=budget, ts_live=time() - self.conf.backfill.live_window)
+		for job in jobs:
+			for dp in self._sa_read(job, res): yield dp
+			self._sa_update(job, res['ts_max'], res['done'])
+			if res['paused']: break
+		else: return
+
+		# Backfill was paused - emit recent samples from the current file ahead of it,
+		#  without updating its position, so these will be sent again when backfill gets there
+		ts_live = datetime.fromtimestamp(res['ts_live'])
+		job = jobs[-1]
+		if job.day.date() != datetime.now().date(): return
+		log.debug( 'Backfill limit reached, sending only'
+			' recent samples from {} on this run'.format(job.path) )
+		cmd = ['sadf', '-jt']
+		if ts_live.date() == job.day.date(): cmd.extend(['-s', ts_live.strftime('%H:%M:%S')])
+		cmd.extend(['--', '-A', job.path])
+		res = dict(budget=None)
+		for dp in self._sa_read(job._replace(cmd=cmd), res): yield dp
 
 
 	def read(self):
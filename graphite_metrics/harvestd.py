@@ -56,6 +56,16 @@ def main():
 		help='Emulate filesystem extended attributes (used in'
 			' some collectors like sysstat or cron_log), storing per-path'
 			' data in a simple shelve db.')
+	parser.add_argument('--record', metavar='path',
+		help='Record all data polled from collectors, with cycle/poll timestamps, to'
+			' specified file, which can be replayed later (see --replay).')
+	parser.add_argument('--replay', metavar='path',
+		help='Instead of using any collectors, replay data from a file (recorded'
+			' with --record) through processors and sinks, exiting when it ends.'
+			' Requires loop that has cycle() method, like the ones derived from "basic".')
+	parser.add_argument('--replay-speed', type=float, default=1.0, metavar='factor',
+		help='Relative speed of --replay, with 0 meaning'
+			' "as fast as possible" (default: %(default)s - same as recorded).')
 	parser.add_argument('-n', '--dry-run',
 		action='store_true', help='Do not actually send data.')
 	parser.add_argument('--debug-memleaks', action='store_true',
@@ -134,6 +144,10 @@ def main():
 	for ep_type in 'collector', 'processor', 'sink':
 		ep_key = '{}s'.format(ep_type) # a bit of a hack
 		conf_base, conf, objects, enabled, disabled = ep_conf[ep_key]
+		if ep_type == 'collector' and optz.replay:
+			log.debug('Using recorded data instead of collectors: {}'.format(optz.replay))
+			objects['_replay'] = collectors.ReplayCollector(optz.replay, optz.replay_speed)
+			continue
 		ep_dict = dict( (ep.name, ep) for ep in
 			pkg_resources.iter_entry_points('graphite_metrics.{}'.format(ep_key)) )
 		eps = OrderedDict(
@@ -157,7 +171,15 @@ def main():
 					log.exception('Failed to load/init {} ({}): {}'.format(ep_type, ep_name, err))
 					subconf.enabled = False
 					obj = None
-				if subconf.get('enabled', True): objects[ep_name] = obj
+				if subconf.get('enabled', True):
+					if ep_type == 'collector' and subconf.isolate:
+						log.debug('Running collector in a child process: {}'.format(ep_name))
+						obj = collectors.IsolatedCollector(obj)
+					elif ep_type == 'sink' and subconf.queue.enabled:
+						log.debug('Using queued dispatch for sink: {}'.format(ep_name))
+						obj = sinks.QueuedSink( obj, subconf.queue.size,
+							subconf.queue.overflow, subconf.queue.get('max_datapoints') )
+					objects[ep_name] = obj
 				else:
 					log.debug(( '{} {} (entry point: {})'
 						' was disabled after init' ).format(ep_type.title(), obj, ep_name))
@@ -171,12 +193,40 @@ def main():
 	conf = AttrDict(**cfg.loop)
 	if 'debug' not in conf: conf.debug = cfg.debug
 	loop = loop[cfg.loop.name].load().loop(conf)
+	if optz.record: loop.recorder = collectors.Recorder(optz.record)
+	if cfg.core.get('counter_state') and not optz.replay:
+		loop.counter_snapshot = collectors.CounterSnapshot(
+			cfg.core.counter_state, collectors.Datapoint._counter_cache )
+		log.debug('Loaded {} counter values from: {}'.format(
+			loop.counter_snapshot.load(), cfg.core.counter_state ))
 
 	collectors, processors, sinks = it.imap( op.itemgetter(2),
 		op.itemgetter('collectors', 'processors', 'sinks')(ep_conf) )
 	log.debug(
 		'Starting main loop: {} ({} collectors, {} processors, {} sinks)'\
 		.format(loop, len(collectors), len(processors), len(sinks)) )
+	if cfg.loop.get('batch_size') and not optz.replay:
+		# Datapoints are still collected into a list for each poll in these cases
+		if optz.record:
+			log.warn( 'loop.batch_size is not applied with --record option'
+				' - all datapoints from each collector poll are buffered in memory' )
+		for name, collector in collectors.viewitems():
+			if not collector.conf.get('timeout'): continue
+			log.warn(( 'loop.batch_size is not applied to collector with timeout option'
+				' ({}) - all datapoints from each poll are buffered in memory' ).format(name))
+
+	if optz.replay:
+		if not hasattr(loop, 'cycle'):
+			log.fatal('Loop {} does not support replaying data (no cycle() method)'.format(loop))
+			sys.exit(1)
+		replay = collectors['_replay']
+		while not replay.done: loop.cycle(collectors, processors, sinks)
+		from graphite_metrics.sinks import QueuedSink
+		for sink in sinks.viewvalues(): # flush all queued data before exit
+			if isinstance(sink, QueuedSink): sink.join()
+		log.debug('Finished replaying data from: {}'.format(optz.replay))
+		return
+
 	loop.start(collectors, processors, sinks)
 
 if __name__ == '__main__': main()
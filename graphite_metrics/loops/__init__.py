@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
-from time import time
+from time import time, sleep
+from threading import Thread, Event
+import os
+
+from ..collectors import Collector, Datapoint
 
 import logging
 log = logging.getLogger(__name__)
@@ -12,12 +16,184 @@ log = logging.getLogger(__name__)
 cfg = dict()
 
 
+def _monotonic_time_func():
+	import ctypes, ctypes.util
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+	try:
+		clock_gettime = ctypes.CDLL(
+			ctypes.util.find_library('rt'), use_errno=True ).clock_gettime
+	except (OSError, AttributeError) as err:
+		log.warn( 'Failed to get clock_gettime() from libc, will'
+			' use non-monotonic time() for scheduling instead: {}'.format(err) )
+		return time
+	clock_gettime.argtypes = ctypes.c_int, ctypes.POINTER(timespec)
+	def monotonic_time(_clock_id=1): # CLOCK_MONOTONIC
+		ts = timespec()
+		if clock_gettime(_clock_id, ctypes.pointer(ts)) != 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		return ts.tv_sec + ts.tv_nsec * 1e-9
+	return monotonic_time
+
+monotonic_time = _monotonic_time_func()
+
+
+class Ticker(object):
+
+	'''Drift-free scheduler for fixed-interval ticks, using monotonic clock.
+		Overruns (cycles ending after the next tick was due) are logged, counted and
+				handled according to the policy, which can be one of:
+			skip - skip missed ticks, waiting for the next one on the same time grid,
+			catchup - run missed ticks back-to-back (without sleeping) until caught up,
+			stretch - start next tick right after the overrun, shifting the grid.'''
+
+	policies = 'skip', 'catchup', 'stretch'
+
+	def __init__(self, interval, policy='skip', time_func=monotonic_time):
+		if policy not in self.policies:
+			raise ValueError('Unknown overrun policy: {!r}'.format(policy))
+		self.interval, self.policy, self.time_func = interval, policy, time_func
+		self.ts = self.ts_missed = self.time_func()
+		self.overruns = self.missed = 0
+
+	def wait(self):
+		'''Sleeps until the next tick.
+			Returns number of newly-missed (skipped or delayed) ticks, 0 if there was no overrun.'''
+		ts_now, missed = self.time_func(), 0
+		self.ts += self.interval
+		if ts_now > self.ts:
+			ticks = int((ts_now - self.ts) // self.interval) + 1
+			missed = ticks - max(0, int(round(
+				(self.ts_missed - self.ts) / self.interval )) + 1 )
+			if missed > 0:
+				self.ts_missed = self.ts + (ticks - 1) * self.interval
+				self.overruns, self.missed = self.overruns + 1, self.missed + missed
+				log.warn(( 'Loop cycle overrun by {:.1f}s, {} tick(s) missed'
+					' (policy: {}, total overruns: {})' ).format(
+						ts_now - self.ts, missed, self.policy, self.overruns ))
+			else: missed = 0
+			if self.policy == 'skip': self.ts += ticks * self.interval
+			elif self.policy == 'stretch': self.ts = ts_now
+		ts_sleep = max(0, self.ts - self.time_func())
+		log.debug('Sleep: {}s'.format(ts_sleep))
+		sleep(ts_sleep)
+		return missed
+
+
 class Loop(object):
 
 	def __init__(self, conf, time_func=time):
 		self.conf, self.time_func = conf, time_func
+		self.stats = dict() # internal metrics, name: (type, value)
+		self._deadlines = dict() # per-collector state for poll_deadline
+		self.recorder = None # collectors.Recorder to write all polled data to
+		self.counter_snapshot = None # collectors.CounterSnapshot to sync after each cycle
+
+	def stats_collector(self, collectors, sinks):
+		'Returns collectors with LoopStats pseudo-collector added, if enabled.'
+		if not self.conf.get('self_stats'): return collectors
+		collectors = collectors.copy()
+		collectors['_self_stats'] = LoopStats(self, sinks)
+		return collectors
+
+	def iter_collector(self, name, collector):
+		'''Returns iterable of datapoints from a single collector, yielded as it generates these.
+			Errors are logged, datapoints yielded before these are still passed on.
+			If collector has "timeout" option set, it is polled from a separate thread instead,
+				with all results discarded if it doesn't finish in time (see poll_deadline).
+			If "recorder" is set, all datapoints are passed to it after poll is finished.'''
+		data = self._iter_collector(name, collector)
+		if not self.recorder or name.startswith('_'): return data # skip internal ones
+		data = list(data)
+		self.recorder.poll(name, self.time_func(), data)
+		return iter(data)
+
+	def _iter_collector(self, name, collector):
+		log.debug('Polling data from a collector (name: {}): {}'.format(name, collector))
+		timeout = collector.conf.get('timeout')
+		if timeout:
+			for dp in self.poll_deadline(name, collector, timeout) or list(): yield dp
+			return
+		try:
+			for dp in collector.read(): yield dp
+		except Exception as err:
+			log.exception( 'Failed to poll collector'
+				' (name: {}, obj: {}): {}'.format(name, collector, err) )
+
+	def poll_deadline(self, name, collector, timeout):
+		'''Runs collector.read() in a thread, returning list of datapoints from it,
+				or None if it has missed the deadline or was skipped due to backoff.
+			On timeout, collector.cancel() is called (to kill subprocesses and such),
+				timeouts counter is incremented in loop stats and,
+				if "timeout_backoff" is set, collector will be skipped on the next
+				poll(s), doubling number of these on each consecutive timeout, up to that value.'''
+		state = self._deadlines.setdefault(name, dict(worker=None, skip=0, streak=0))
+		if state['skip'] > 0:
+			state['skip'] -= 1
+			log.debug('Skipping poll of collector {} due to timeout backoff'.format(name))
+			return
+		if state['worker'] and state['worker'].is_alive():
+			log.warn(( 'Previous poll of collector {} has timed out'
+				' and is still running, skipping it' ).format(name))
+			return
+
+		data, cancelled = list(), Event()
+		def worker():
+			try:
+				for dp in collector.read():
+					if cancelled.is_set(): break
+					data.append(dp)
+			except Exception as err:
+				if cancelled.is_set(): return
+				log.exception( 'Failed to poll collector'
+					' (name: {}, obj: {}): {}'.format(name, collector, err) )
+		state['worker'] = Thread(target=worker, name='collector:{}'.format(name))
+		state['worker'].daemon = True
+		state['worker'].start()
+		state['worker'].join(timeout)
+
+		if not state['worker'].is_alive():
+			state['streak'] = 0
+			return data
+		cancelled.set()
+		log.warn(( 'Collector {} has missed its deadline ({}s),'
+			' discarding {} datapoint(s) from it' ).format(name, timeout, len(data)))
+		try: collector.cancel()
+		except Exception as err:
+			log.exception('Failed to cancel collector poll (name: {}): {}'.format(name, err))
+		k = 'collectors.{}.timeouts'.format(name)
+		self.stats[k] = 'gauge', self.stats.get(k, (None, 0))[1] + 1
+		backoff = collector.conf.get('timeout_backoff')
+		if backoff:
+			state['skip'] = min(backoff, 2**state['streak'])
+			state['streak'] += 1
+			log.info('Skipping next {} poll(s) of collector {}'.format(state['skip'], name))
+
+	def poll_collector(self, name, collector):
+		'Returns list of datapoints from a single collector.'
+		return list(self.iter_collector(name, collector))
 
 	def start(self, collectors, processors, sinks):
 		raise NotImplementedError( 'Loop.start method should be'
 			' overidden in loop subclasses to start poll/process/send loop'
 			' using passed Collector, Processor and Sink objects.' )
+
+
+class LoopStats(Collector):
+
+	'''Pseudo-collector for internal harvestd metrics (loop stats, sink queues, etc),
+		added to collectors by loops if "self_stats" option (metric name prefix) is set.'''
+
+	def __init__(self, loop, sinks):
+		super(LoopStats, self).__init__(dict())
+		self.loop, self.sinks, self.prefix = loop, sinks, loop.conf.self_stats
+
+	def read(self):
+		stats = self.loop.stats.items()
+		for name, sink in self.sinks.viewitems():
+			if not hasattr(sink, 'stats'): continue
+			stats.extend( ('sinks.{}.{}'.format(name, k), v)
+				for k, v in sink.stats().viewitems() )
+		for name, (val_type, val) in stats:
+			yield Datapoint('{}.{}'.format(self.prefix, name), val_type, val, None)
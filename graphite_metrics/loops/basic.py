@@ -2,7 +2,8 @@
 
 import itertools as it, operator as op, functools as ft
 
-from . import Loop
+from . import Loop, Ticker
+from ..collectors import DatapointBatch, snapshots, backpressure
 
 import logging
 log = logging.getLogger(__name__)
@@ -10,54 +11,86 @@ log = logging.getLogger(__name__)
 
 class BasicLoop(Loop):
 
-	'Simple synchronous "while True: fetch && process && send" loop.'
+	'''Simple synchronous "while True: fetch && process && send" loop.
+		If "batch_size" option is set, datapoints are pulled from collectors,
+			processed and sent in batches of (at most) that size, instead of collecting
+			all of them first, so that memory usage doesn't depend on the amount of data.'''
 
-	def start(self, collectors, processors, sinks):
-		from time import time, sleep
+	def poll_iter(self, collectors):
+		return it.chain.from_iterable(
+			it.starmap(self.iter_collector, collectors.viewitems()) )
 
-		ts = self.time_func()
-		while True:
-			data = list()
-			for name, collector in collectors.viewitems():
-				log.debug('Polling data from a collector (name: {}): {}'.format(name, collector))
-				try: data.extend(collector.read())
+	def poll(self, collectors):
+		return list(self.poll_iter(collectors))
+
+	def process(self, data, ts_now, processors, sinks):
+		'''Returns dict of datapoint batch lists, to be dispatched on per-sink basis.
+			Datapoints are passed through processors in batches, grouped by sinks they're routed to.
+			Batches are either lists of tuples or DatapointBatch objects, as yielded by collectors.'''
+		dps, batches = list(), list()
+		for dp in it.ifilter(None, (dp.get(ts=ts_now) for dp in data)):
+			if isinstance(dp, DatapointBatch): batches.append(dp)
+			else: dps.append(dp)
+		batches = list((batch, sinks) for batch in [dps] + batches if batch)
+		log.debug('Processing {} datapoints'.format(sum(len(batch) for batch, sinks in batches)))
+		for name, proc in processors.viewitems():
+			batches_proc = list()
+			for batch, batch_sinks in batches:
+				try: batches_proc.extend(proc.process_batch(batch, batch_sinks))
 				except Exception as err:
-					log.exception( 'Failed to poll collector'
-						' (name: {}, obj: {}): {}'.format(name, collector, err) )
+					log.exception(( 'Failed to process datapoints (count: {},'
+						' processor: {}, obj: {}): {}, discarding' ).format(len(batch), name, proc, err))
+			batches = list((batch, batch_sinks) for batch, batch_sinks in batches_proc if batch)
+		sink_data = dict()
+		for batch, batch_sinks in batches:
+			for name in batch_sinks: sink_data.setdefault(name, list()).append(batch)
+		return sink_data
+
+	def dispatch(self, sink_data, sinks):
+		log.debug('Dispatching data to {} sink(s)'.format(len(sink_data)))
+		if self.conf.debug.dry_run: return
+		for name, batches in sink_data.viewitems():
+			sink = sinks[name]
+			log.debug(( 'Sending {} datapoints to sink (name: {}): {}' )\
+				.format(sum(it.imap(len, batches)), name, sink))
+			try: sink.dispatch_batches(*batches)
+			except Exception as err:
+				log.exception( 'Failed to dispatch data to sink'
+					' (name: {}, obj: {}): {}'.format(name, sink, err) )
 
+	def cycle(self, collectors, processors, sinks):
+		'Runs poll/process/dispatch sequence once, returns timestamp for processed data.'
+		snapshots.invalidate()
+		try: backpressure.update(sinks)
+		except Exception as err:
+			log.exception('Failed to get sink backpressure level: {}'.format(err))
+		for collector in collectors.viewvalues(): collector.cycle_start()
+		if self.recorder: self.recorder.cycle(self.time_func())
+		batch_size = self.conf.get('batch_size')
+		if not batch_size:
+			data = self.poll(collectors)
 			ts_now = self.time_func()
-			sink_data = dict() # to batch datapoints on per-sink basis
-
-			log.debug('Processing {} datapoints'.format(len(data)))
-			for dp in it.ifilter(None, (dp.get(ts=ts_now) for dp in data)):
-				proc_sinks = sinks.copy()
-				for name, proc in processors.viewitems():
-					if dp is None: break
-					try: dp, sinks = proc.process(dp, sinks)
-					except Exception as err:
-						log.exception(( 'Failed to process datapoint (data: {},'
-							' processor: {}, obj: {}): {}, discarding' ).format(dp, name, proc, err))
-						break
-				else:
-					if dp is None: continue
-					for name, sink in proc_sinks.viewitems():
-						try: sink_data[name].append(dp)
-						except KeyError: sink_data[name] = [dp]
-
-			log.debug('Dispatching data to {} sink(s)'.format(len(sink_data)))
-			if not self.conf.debug.dry_run:
-				for name, tuples in sink_data.viewitems():
-					log.debug(( 'Sending {} datapoints to sink'
-						' (name: {}): {}' ).format(len(tuples), name, sink))
-					try: sinks[name].dispatch(*tuples)
-					except Exception as err:
-						log.exception( 'Failed to dispatch data to sink'
-							' (name: {}, obj: {}): {}'.format(name, sink, err) )
-
-			while ts < ts_now: ts += self.conf.interval
-			ts_sleep = max(0, ts - self.time_func())
-			log.debug('Sleep: {}s'.format(ts_sleep))
-			sleep(ts_sleep)
+			self.dispatch(self.process(data, ts_now, processors, sinks), sinks)
+		else:
+			data, ts_now = self.poll_iter(collectors), self.time_func()
+			while True:
+				batch = list(it.islice(data, batch_size))
+				if not batch: break
+				ts_now = self.time_func()
+				self.dispatch(self.process(batch, ts_now, processors, sinks), sinks)
+		if self.counter_snapshot: self.counter_snapshot.sync()
+		return ts_now
+
+	def start(self, collectors, processors, sinks):
+		collectors = self.stats_collector(collectors, sinks)
+		ticker = Ticker(self.conf.interval, self.conf.get('overrun_policy') or 'skip')
+		while True:
+			ts_cycle = ticker.time_func()
+			self.cycle(collectors, processors, sinks)
+			self.stats['loop.cycle_time'] = 'gauge', ticker.time_func() - ts_cycle
+			ticker.wait()
+			self.stats['loop.overruns'] = 'gauge', ticker.overruns
+			self.stats['loop.ticks_missed'] = 'gauge', ticker.missed
 
 
 loop = BasicLoop
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from multiprocessing.pool import ThreadPool
+from threading import Event
+from Queue import Queue
+
+from .basic import BasicLoop
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ConcurrentLoop(BasicLoop):
+
+	'''Same as BasicLoop, but polls all collectors in parallel,
+			using bounded pool of threads and gathering results as they finish.
+		Processing and dispatching of collected datapoints is done in the main thread.
+		With "batch_size" set, threads pass datapoints to it in chunks of that size
+			through a bounded queue (of "threads" chunks), and block when it's full,
+			so that memory usage doesn't depend on amount of data from collectors.'''
+
+	pool = None
+
+	def poll_iter(self, collectors):
+		if not self.pool:
+			threads = self.conf.threads or len(collectors)
+			log.debug('Starting pool of {} collector-polling threads'.format(threads))
+			self.pool = ThreadPool(max(1, min(threads, len(collectors))))
+		if self.conf.get('batch_size'): return self._poll_iter_stream(collectors)
+		return self._poll_iter(collectors)
+
+	def _poll_iter(self, collectors):
+		for name, dps in self.pool.imap_unordered(
+				self._poll_collector, collectors.items() ):
+			log.debug('Collector finished (name: {}, datapoints: {})'.format(name, len(dps)))
+			for dp in dps: yield dp
+
+	def _poll_collector(self, item):
+		name, collector = item
+		return name, self.poll_collector(name, collector)
+
+	def _poll_iter_stream(self, collectors):
+		chunks, aborted = Queue(max(1, self.conf.threads or len(collectors))), Event()
+		for item in collectors.viewitems():
+			self.pool.apply_async(self._poll_collector_stream, (item, chunks, aborted))
+		running = len(collectors)
+		try:
+			while running:
+				name, dps = chunks.get()
+				if dps is None:
+					log.debug('Collector finished (name: {})'.format(name))
+					running -= 1
+				else:
+					for dp in dps: yield dp
+		finally:
+			if running: # generator was closed - stop and wait for all threads
+				aborted.set()
+				while running:
+					if chunks.get()[1] is None: running -= 1
+
+	def _poll_collector_stream(self, item, chunks, aborted):
+		'''Puts chunks of up to batch_size datapoints from collector to "chunks" queue,
+			followed by (name, None) when done, stopping early if "aborted" is set.'''
+		name, collector = item
+		try:
+			data, batch_size = self.iter_collector(name, collector), self.conf.batch_size
+			while not aborted.is_set():
+				dps = list(it.islice(data, batch_size))
+				if not dps: break
+				chunks.put((name, dps))
+		except Exception as err: # iter_collector catches errors from collectors
+			log.exception('Failed to poll collector (name: {}): {}'.format(name, err))
+		finally: chunks.put((name, None))
+
+
+loop = ConcurrentLoop
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
+from heapq import heapify, heappush, heappop
+
+from . import monotonic_time
+from .basic import BasicLoop
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ScheduledLoop(BasicLoop):
+
+	'''Polls each collector with its own interval ("poll_interval" collector
+			option, falling back to loop.interval), keeping a heap of next poll times
+			and only polling collectors that are due, processing/sending their data together.
+		Intervals of counter rates are tracked per-counter, so these are unaffected.'''
+
+	def start(self, collectors, processors, sinks):
+		from time import sleep
+
+		collectors = self.stats_collector(collectors, sinks)
+		ts, schedule = monotonic_time(), list()
+		for n, (name, collector) in enumerate(collectors.viewitems()):
+			interval = collector.conf.get('poll_interval') or self.conf.interval
+			log.debug('Poll interval for collector {}: {}s'.format(name, interval))
+			schedule.append((ts, n, name, interval))
+		heapify(schedule)
+		self.stats['loop.ticks_missed'] = 'gauge', 0
+
+		while True:
+			ts_now, due = monotonic_time(), OrderedDict()
+			while schedule[0][0] <= ts_now:
+				ts, n, name, interval = heappop(schedule)
+				due[name] = collectors[name]
+				ts += interval
+				if ts <= ts_now:
+					missed = int((ts_now - ts) // interval) + 1
+					log.warn(( 'Collector poll overrun by {:.1f}s'
+						' (name: {}), {} tick(s) skipped' ).format(ts_now - ts, name, missed))
+					self.stats['loop.ticks_missed'] = 'gauge',\
+						self.stats['loop.ticks_missed'][1] + missed
+					ts += missed * interval
+				heappush(schedule, (ts, n, name, interval))
+
+			if due:
+				log.debug('Collectors due to be polled: {}'.format(', '.join(due)))
+				self.cycle(due, processors, sinks)
+
+			ts_sleep = max(0, schedule[0][0] - monotonic_time())
+			log.debug('Sleep: {}s'.format(ts_sleep))
+			sleep(ts_sleep)
+
+loop = ScheduledLoop
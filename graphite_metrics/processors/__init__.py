@@ -15,3 +15,24 @@ class Processor(object):
 		raise NotImplementedError( 'Processor.process method'
 			' should be overidden in processor subclasses to mangle'
 			' (name, value, timestamp) tuple in some way.' )
+
+	def process_batch(self, datapoints, sinks):
+		'''Processes batch of datapoint tuples, which are all routed to the same sinks.
+			Batch can be either a list or collectors.DatapointBatch, which can be iterated over.
+			Returns iterable of (datapoints, sinks) pairs, grouping resulting datapoints by
+				sinks they should be sent to, so that routing is expressed per-group, not per-datapoint.
+			Passed sinks dict should not be modified, new one should be returned instead.
+			Default implementation calls process() for each datapoint,
+				and should be overidden in subclasses where that can be avoided.'''
+		groups = dict()
+		for dp in datapoints:
+			try: dp, dp_sinks = self.process(dp, sinks.copy())
+			except Exception as err:
+				log.exception(( 'Failed to process datapoint (data: {},'
+					' processor: {}): {}, discarding' ).format(dp, self, err))
+				continue
+			if dp is None: continue
+			key = frozenset(dp_sinks)
+			try: groups[key][0].append(dp)
+			except KeyError: groups[key] = [dp], dp_sinks
+		return groups.viewvalues()
@@ -4,6 +4,7 @@ import itertools as it, operator as op, functools as ft
 import os
 
 from . import Processor
+from ..collectors import DatapointBatch
 
 import logging
 log = logging.getLogger(__name__)
@@ -23,5 +24,12 @@ class HostnamePrefix(Processor):
 		name, value, ts_dp = dp_tuple
 		return (self.prefix + name, value, ts_dp), sinks
 
+	def process_batch(self, datapoints, sinks):
+		prefix = self.prefix
+		if isinstance(datapoints, DatapointBatch):
+			return [(datapoints.with_prefix(prefix), sinks)]
+		return [( list( (prefix + name, value, ts_dp)
+			for name, value, ts_dp in datapoints ), sinks )]
+
 
 processor = HostnamePrefix
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
+from Queue import Queue
 
 import logging
 log = logging.getLogger(__name__)
@@ -14,3 +15,107 @@ class Sink(object):
 	def dispatch(self, *tuples):
 		raise NotImplementedError( 'Sink.dispatch method should be overidden in sink'
 			' subclasses to dispatch (metric_name, value, timestamp) tuples to whatever destination.' )
+
+	def dispatch_batches(self, *batches):
+		'''Dispatches batches of datapoints - lists of tuples or
+				collectors.DatapointBatch objects, which also iterate over tuples.
+			Default implementation passes all tuples from these to dispatch(),
+				and can be overidden in subclasses that can handle DatapointBatch natively.'''
+		self.dispatch(*it.chain.from_iterable(batches))
+
+	def pressure(self):
+		'''Returns how backed-up the sink is, from 0 (not at all) to 1 (full),
+			which collectors can use to delay sending non-urgent data, see collectors.Backpressure.'''
+		return 0
+
+
+class DatapointQueue(Queue):
+
+	'''Queue of dispatch_batches() arguments, with maxsize
+		and qsize() counted in datapoints instead of queue entries.
+		Queue is full when it has maxsize or more datapoints, so last entry can go over it.'''
+
+	def _init(self, maxsize):
+		Queue._init(self, maxsize)
+		self.datapoints = 0
+
+	def _qsize(self, len=len):
+		size = max(self.datapoints, len(self.queue))
+		return size if self.maxsize <= 0 else min(size, self.maxsize)
+
+	def _put(self, batches):
+		Queue._put(self, batches)
+		self.datapoints += sum(it.imap(len, batches))
+
+	def _get(self):
+		batches = Queue._get(self)
+		self.datapoints -= sum(it.imap(len, batches))
+		return batches
+
+
+class QueuedSink(object):
+
+	'''Wrapper to dispatch datapoints to a Sink from a separate worker thread
+			through a bounded queue of datapoint batches, so that dispatch() never
+			has to wait for a slow or stuck (e.g. reconnecting) sink.
+		Queue size is a number of dispatched sets of batches (one per cycle, or one per
+			loop.batch_size chunk with it set), or a number of datapoints, if "max_datapoints" is set.
+		Overflow policy determines what happens to new batches when queue is full:
+			"drop_oldest", "drop_newest" or "block" (wait for free slot, same as non-queued sink).'''
+
+	overflow_policies = 'drop_oldest', 'drop_newest', 'block'
+
+	def __init__(self, sink, size=16, overflow='drop_oldest', max_datapoints=None):
+		from threading import Thread
+		if overflow not in self.overflow_policies:
+			raise ValueError('Unknown queue overflow policy: {!r}'.format(overflow))
+		self.sink, self.overflow, self.dropped = sink, overflow, 0
+		self.queue = Queue(size) if not max_datapoints else DatapointQueue(max_datapoints)
+		self.worker = Thread(target=self._worker, name='sink:{}'.format(sink))
+		self.worker.daemon = True
+		self.worker.start()
+
+	@property
+	def conf(self): return self.sink.conf
+
+	def __repr__(self): return '<QueuedSink {!r}>'.format(self.sink)
+
+	def _worker(self):
+		while True:
+			batches = self.queue.get()
+			try: self.sink.dispatch_batches(*batches)
+			except Exception as err:
+				log.exception('Failed to dispatch data to sink ({}): {}'.format(self.sink, err))
+			finally: self.queue.task_done()
+
+	def dispatch(self, *tuples):
+		self.dispatch_batches(tuples)
+
+	def dispatch_batches(self, *batches):
+		from Queue import Full, Empty
+		if self.overflow == 'block': return self.queue.put(batches)
+		while True:
+			try: self.queue.put_nowait(batches)
+			except Full:
+				if self.overflow == 'drop_oldest':
+					try: self.queue.get_nowait()
+					except Empty: continue
+					self.queue.task_done()
+				self.dropped += 1
+				log.warn(( 'Sink queue overflow ({}), dropping {} datapoint batch'
+					' (total dropped: {})' ).format(self.sink, self.overflow[5:], self.dropped))
+				if self.overflow == 'drop_newest': break
+			else: break
+
+	def join(self):
+		'Blocks until all queued datapoints are dispatched.'
+		self.queue.join()
+
+	def pressure(self):
+		if self.queue.maxsize <= 0: return 0 # unbounded queue
+		return min(1, float(self.queue.qsize()) / self.queue.maxsize)
+
+	def stats(self):
+		'Returns dict of internal metrics as (type, value) tuples.'
+		return dict( queue_depth=('gauge', self.queue.qsize()),
+			dropped_batches=('gauge', self.dropped) )
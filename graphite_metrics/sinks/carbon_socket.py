@@ -5,6 +5,7 @@ from time import sleep
 import socket
 
 from . import Sink
+from ..collectors import DatapointBatch
 
 import logging
 log = logging.getLogger(__name__)
@@ -61,9 +62,22 @@ class CarbonSocket(Sink):
 		self.close()
 		self.connect(send=send)
 
+	@staticmethod
+	def format_batch(batch):
+		if isinstance(batch, DatapointBatch) and isinstance(batch.ts, (int, long)):
+			# Shared prefix and timestamp are formatted only once for the whole batch
+			line = '{}{{}} {{}} {}\n'.format(
+				(batch.prefix or '').replace('{', '{{').replace('}', '}}'), batch.ts )
+			return ''.join(it.imap(line.format, batch.names, batch.values))
+		return ''.join(it.starmap('{} {} {}\n'.format, batch))
+
 	def dispatch(self, *tuples):
-		reconnects = self.conf.max_reconnects
-		packet = ''.join(it.starmap('{} {} {}\n'.format, tuples))
+		self.send(self.format_batch(tuples))
+
+	def dispatch_batches(self, *batches):
+		self.send(''.join(it.imap(self.format_batch, batches)))
+
+	def send(self, packet):
 		try: self.sock.sendall(packet)
 		except socket.error as err:
 			log.error('Failed to send data to Carbon server: {}'.format(err))
@@ -55,6 +55,7 @@ setup(
 
 	install_requires = ['layered-yaml-attrdict-config', 'setuptools'],
 	extras_require = {
+		'core.numpy': ['numpy'],
 		'collectors.cgacct': ['dbus-python'],
 		'collectors.cron_log': ['xattr', 'iso8601'],
 		'collectors.sysstat': ['xattr'],